@@ -0,0 +1,83 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Takes one token. Returns 0 when admitted, otherwise the seconds until a token is available."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """One token bucket per (client, route class).
+
+    `limits` maps each route class to (requests per second, burst). Only the `max_keys` most
+    recently seen clients keep a bucket, so memory stays bounded however many clients show up.
+    """
+
+    def __init__(self, limits, max_keys=100000):
+        self.limits = limits
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, client, route_class):
+        key = (client, route_class)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                rate, burst = self.limits[route_class]
+                bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.take(now)
+
+
+class ConcurrencyGate:
+    """Caps the requests using the database at the same time.
+
+    Requests over the limit wait in a bounded queue for at most `timeout` seconds. When the queue
+    is full they are turned away at once: failing fast beats piling up connections on Postgres.
+    """
+
+    def __init__(self, limit, max_queue, timeout):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(limit)
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self._semaphore.acquire(blocking=False):
+            return True
+
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                return False
+            self._waiting += 1
+        try:
+            return self._semaphore.acquire(timeout=self.timeout)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def release(self):
+        self._semaphore.release()
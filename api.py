@@ -1,20 +1,200 @@
+import os
+import json
+import math
+import time
 import flask
 import logging
+import uuid
 import datetime
 import psycopg2
-from load_data import db_connection
+import threading
+from db import db_connection, setting, web_concurrency, api_threads
+from bulk_update import apply_feed
+from serializers import ITEM_SCHEMA, CLIENT_SCHEMA, ORDER_SCHEMA, ORDER_ITEM_SCHEMA, CART_LINE_SCHEMA, json_response, parse_fields, project_fields
+from cache import LRUCache
+from admission import RateLimiter, ConcurrencyGate
+from db_guard import CircuitOpenError, breaker, guarded_connection
+from slow_queries import slow_query_log
+from notifications import NotificationListener
+from catalog import CatalogReplica
+import metrics
 from flask import render_template
-from dotenv import dotenv_values
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 StatusCodes = {
     'success': 200,
+    'accepted': 202,
     'api_error': 400,  # error: bad request (request error)
     'internal_error': 500,  # error: internal server error (API error)
     'not_found': 404,
+    'conflict': 409,
+    'too_many_requests': 429,
+    'unavailable': 503,
 }
 
+MAX_ITEMS_BATCH = setting('MAX_ITEMS_BATCH', 100, int)
+
+# priced cart snapshots per client, see get_cart. CART_CACHE_TTL=0 disables it.
+cart_cache = LRUCache(maxsize=setting('CART_CACHE_SIZE', 10000, int),
+                      ttl=setting('CART_CACHE_TTL', 30, float))
+
+# co-purchase lists, built once per worker and rebuilt in the background every RECOMMENDER_REFRESH seconds
+# (maintain_recommender). Created by refresh_recommender, numpy and scipy are only imported then.
+recommender = None
+RECOMMENDER_TOP_K = setting('RECOMMENDER_TOP_K', 10, int)
+RECOMMENDER_REFRESH = setting('RECOMMENDER_REFRESH', 3600, float)
+RECOMMENDER_RETRY = setting('RECOMMENDER_RETRY', 5, float)  # first wait after a failed build, doubled up to RECOMMENDER_REFRESH
+recommender_next_build = None  # monotonic time of the next attempt while the first build hasn't landed
+recommender_refresh = threading.Lock()
+# (order_id, item_ids) of the orders checked out while a rebuild runs, its SELECT may not see them;
+# None when no rebuild is running. recommender_swap guards it together with the swap itself.
+recommender_pending = None
+recommender_swap = threading.Lock()
+
+# one LISTEN connection per process, started in init_worker
+listener = NotificationListener(db_connection)
+# the cart cache is only used while the listener is up and the triggers sending the notifications that
+# invalidate it in every worker are installed (python migrate.py), checked every CART_TRIGGER_CHECK seconds
+CART_CACHE_MAX_LAG = setting('CART_CACHE_MAX_LAG', 5, float)
+CART_TRIGGER_CHECK = setting('CART_TRIGGER_CHECK', 60, float)
+CART_CACHE_TRIGGERS = [('cart_changes', 'cartitem'), ('cart_changes', 'shoppingcart'), ('item_changes', 'item')]
+cart_triggers_at = None  # monotonic time they were last found installed
+cart_triggers_missing = None
+
+
+def invalidate_priced_carts(payload):
+    if json.loads(payload).get('price_changed'):
+        cart_cache.clear()
+
+
+listener.subscribe('cart_changes', cart_cache.discard, on_reconnect=cart_cache.clear)
+listener.subscribe('item_changes', invalidate_priced_carts)
+
+
+def cart_cache_usable():
+    return (listener.is_alive_within(CART_CACHE_MAX_LAG) and cart_triggers_at is not None and
+            time.monotonic() - cart_triggers_at <= CART_TRIGGER_CHECK)
+
+
+def check_cart_triggers(cur):
+    """Whether the CART_CACHE_TRIGGERS are installed; while they are not the cart cache is emptied."""
+    global cart_triggers_at, cart_triggers_missing
+    checked_at = time.monotonic()
+    cur.execute("""SELECT trigger.name || ' ON ' || trigger.tbl
+                   FROM unnest(%s::text[], %s::text[]) AS trigger(name, tbl)
+                   WHERE NOT EXISTS (SELECT 1 FROM pg_trigger
+                                     WHERE tgname = trigger.name AND tgrelid = to_regclass(trigger.tbl))""",
+                ([name for name, _ in CART_CACHE_TRIGGERS], [table for _, table in CART_CACHE_TRIGGERS]))
+    missing = [row[0] for row in cur.fetchall()]
+    if missing:
+        if cart_triggers_missing is not True:
+            logger.error(f"Cart cache: missing triggers {', '.join(missing)} (run python migrate.py), "
+                         "reading carts from the database")
+        cart_triggers_at = None
+        cart_cache.clear()
+    else:
+        cart_triggers_at = checked_at
+    cart_triggers_missing = bool(missing)
+    return not missing
+
+# read-only copy of the item table serving the items list and details, see catalog.py
+catalog = CatalogReplica(db_connection, listener,
+                         max_staleness=setting('CATALOG_MAX_STALENESS', 5, float),
+                         full_reload=setting('CATALOG_FULL_RELOAD', 300, float))
+CATALOG_REPLICA = setting('CATALOG_REPLICA', '1') == '1'
+
+# (requests per second, burst) per client and route class
+rate_limiter = RateLimiter({
+    'reads': (setting('RATE_LIMIT_READS', 20, float), setting('RATE_BURST_READS', 40, float)),
+    'writes': (setting('RATE_LIMIT_WRITES', 5, float), setting('RATE_BURST_WRITES', 10, float)),
+    'checkout': (setting('RATE_LIMIT_CHECKOUT', 1, float), setting('RATE_BURST_CHECKOUT', 3, float)),
+})
+
+# Postgres' connection budget is shared by every worker process, each one gets its slice of it.
+# A worker never runs more than API_THREADS requests at once, so the gate only engages (and
+# requests only queue in it) when the slice is smaller than that, see check_db_gate.
+DB_MAX_CONNECTIONS = setting('DB_MAX_CONNECTIONS', 90, int)
+db_gate = ConcurrencyGate(
+    limit=setting('DB_MAX_CONCURRENCY', 0, int) or
+          max(1, min(DB_MAX_CONNECTIONS // web_concurrency(), api_threads())),
+    max_queue=setting('ADMISSION_MAX_QUEUE', 50, int),
+    timeout=setting('ADMISSION_QUEUE_TIMEOUT', 2, float))
+
+# endpoints that never touch the database skip admission control
+ADMISSION_EXEMPT = {'landing_page', 'get_metrics', 'get_slow_queries', 'get_export_job', 'static'}
+
 app = flask.Flask(__name__)
 
+# behind N reverse proxies, remote_addr is taken from the last N X-Forwarded-For entries
+TRUSTED_PROXIES = setting('TRUSTED_PROXIES', 0, int)
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+''' ####################### Admission control '''
+
+def route_class():
+    if flask.request.endpoint in ('purchase_items',):
+        return 'checkout'
+    if flask.request.method in ('GET', 'HEAD'):
+        return 'reads'
+    return 'writes'
+
+
+@app.before_request
+def admit_request():
+    if flask.request.endpoint is None or flask.request.endpoint in ADMISSION_EXEMPT:
+        return None
+
+    # not the client_id of the path: the caller picks it, a made-up one would get a fresh burst
+    retry_after = rate_limiter.check(flask.request.remote_addr, route_class())
+    if retry_after:
+        metrics.incr('admission.rate_limited')
+        response = {'status': StatusCodes['too_many_requests'],
+                    'message': 'Too many requests, slow down.'}
+        return json_response(response, headers={'Retry-After': str(math.ceil(retry_after))})
+
+    if not db_gate.acquire():
+        metrics.incr('admission.overloaded')
+        response = {'status': StatusCodes['unavailable'],
+                    'message': 'The service is overloaded, try again shortly.'}
+        return json_response(response, headers={'Retry-After': str(math.ceil(db_gate.timeout))})
+
+    flask.g.admitted = True
+    metrics.incr('admission.admitted')
+    return None
+
+
+@app.teardown_request
+def release_request(error):
+    if flask.g.pop('admitted', False):
+        db_gate.release()
+
+
+def get_db():
+    # connection with the current route's statement/lock timeouts, fails fast while the circuit is open
+    return guarded_connection(flask.request.endpoint)
+
+
+def check_db_gate():
+    """Logs whether the gate can engage with this configuration, and warns when the workers'
+    slices add up to more connections than DB_MAX_CONNECTIONS."""
+    workers, threads = web_concurrency(), api_threads()
+    if workers * db_gate.limit > DB_MAX_CONNECTIONS:
+        logger.warning(f'DB gate: {workers} workers x {db_gate.limit} connections exceed '
+                       f'DB_MAX_CONNECTIONS={DB_MAX_CONNECTIONS}, lower WEB_CONCURRENCY')
+    if db_gate.limit < threads:
+        logger.info(f'DB gate: at most {db_gate.limit} of {threads} threads use the database at once')
+    else:
+        logger.info(f'DB gate: idle, {threads} threads already fit in the {db_gate.limit} connections of this worker')
+
+
+@app.errorhandler(CircuitOpenError)
+def database_unavailable(error):
+    response = {'status': StatusCodes['unavailable'],
+                'message': str(error)}
+    return json_response(response, headers={'Retry-After': str(math.ceil(breaker.retry_after()) or 1)})
+
+
 ''' ####################### Endpoints '''
 
 # http://127.0.0.1:8080/
@@ -33,19 +213,19 @@ def create_item():
     logger.info('POST /proj/api/items')
     payload = flask.request.get_json()
 
-    conn = db_connection()
-    cur = conn.cursor()
-
     needed_parameters = ['name', 'category', 'price', 'stock', 'description', 'manufacturer', 'weight', 'image_url']
-    if set(needed_parameters).union(set(payload.keys())) != set(payload.keys()):
+    if not isinstance(payload, dict) or set(needed_parameters).union(set(payload.keys())) != set(payload.keys()):
         response = {'status': StatusCodes['api_error'],
                     'errors': 'Incorrect Parameters'}
-        return flask.jsonify(response), response['status']
+        return json_response(response)
 
     if payload['price'] < 0 or payload['stock'] < 0 or payload['weight'] < 0:
         response = {'status': StatusCodes['api_error'],
                     'errors': 'Price, Stock and Weight must be greater than or equal to 0'}
-        return flask.jsonify(response), response['status']
+        return json_response(response)
+
+    conn = get_db()
+    cur = conn.cursor()
 
     cur.execute("SELECT name FROM category;")
     existing_categories = {row[0] for row in cur.fetchall()}
@@ -65,7 +245,7 @@ def create_item():
                         'errors': f"The category '{payload['category']}' does not exist and will not be created."}
             conn.rollback()
             conn.close()
-            return flask.jsonify(response), response['status']
+            return json_response(response)
 
     statement = """INSERT INTO item (name, category, price, stock, description, manufacturer, weight, image_url, total_unit_sales)
                     VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
@@ -112,7 +292,7 @@ def create_item():
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 2. Update Item: http://localhost:8080/proj/api/items/{item_id} (PUT)
@@ -121,7 +301,7 @@ def update_item(item_id):
     logger.info(f'PUT /proj/api/items/{item_id}')
     payload = flask.request.get_json()
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     cur.execute("SELECT EXISTS (SELECT 1 FROM item WHERE item_id = %s)", (item_id,))
@@ -130,7 +310,7 @@ def update_item(item_id):
     if not item_exists:
         response = {'status': StatusCodes['not_found'],
                     'message': 'Item not found.'}
-        return flask.jsonify(response), response['status']
+        return json_response(response)
 
     new_category = payload.get('category')
     cur.execute("SELECT name FROM category;")
@@ -152,18 +332,18 @@ def update_item(item_id):
             conn.rollback()
             conn.close()
 
-            return flask.jsonify(response), response['status']
+            return json_response(response)
 
     if not any(param in payload for param in ['name', 'category', 'price', 'stock', 'description', 'manufacturer', 'weight', 'image_url']):
         response = {'status': StatusCodes['api_error'],
                     'errors': 'No valid parameters provided for update.'}
 
-        return flask.jsonify(response), response['status']
+        return json_response(response)
 
     if payload['price'] < 0 or payload['stock'] < 0 or payload['weight'] < 0:
         response = {'status': StatusCodes['api_error'],
                     'errors': 'Price, Stock and Weight must be greater than or equal to 0'}
-        return flask.jsonify(response), response['status']
+        return json_response(response)
 
     try:
         update_columns, update_values = [], []
@@ -193,6 +373,10 @@ def update_item(item_id):
                         'message': 'Item updated successfully.',
                         'data': response_data}
             conn.commit()
+
+            if 'price' in payload:
+                # any cached cart can hold this item, there is no item -> carts index to be more selective
+                cart_cache.clear()
         else:
             response = {'status': StatusCodes['api_error'],
                         'results': 'No valid update parameters provided'}
@@ -207,7 +391,7 @@ def update_item(item_id):
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 3. Delete Item from Cart: http://localhost:8080/proj/api/carts/{client_id}/items/{item_id} (DELETE)
@@ -215,7 +399,7 @@ def update_item(item_id):
 def delete_item_from_cart(client_id, item_id):
     logger.info(f'DELETE /proj/api/carts/{client_id}/items/{item_id}')
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     try:
@@ -238,6 +422,7 @@ def delete_item_from_cart(client_id, item_id):
                             'message': 'Item deleted from cart.'}
 
                 conn.commit()
+                cart_cache.discard(client_id)
             else:
                 response = {'status': StatusCodes['api_error'],
                             'message': 'Item not found in the cart for the specified client.'}
@@ -255,7 +440,7 @@ def delete_item_from_cart(client_id, item_id):
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 4. Add Item to Cart: http://localhost:8080/proj/api/cart/{client_id} (POST)
@@ -263,7 +448,7 @@ def delete_item_from_cart(client_id, item_id):
 def add_item_to_cart(client_id):
     logger.info(f'POST /proj/api/cart/{client_id}')
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     try:
@@ -273,14 +458,14 @@ def add_item_to_cart(client_id):
         if not cart_exists:
             response = {'status': StatusCodes['not_found'],
                         'message': 'Cart not found.'}
-            return flask.jsonify(response), response['status']
+            return json_response(response)
 
         request_data = flask.request.get_json()
 
         if 'item_id' not in request_data or 'quantity' not in request_data:
             response = {'status': StatusCodes['api_error'],
                         'message': 'Request body must contain "item_id" and "quantity".'}
-            return flask.jsonify(response), response['status']
+            return json_response(response)
 
         item_id = request_data['item_id']
         quantity = request_data['quantity']
@@ -291,11 +476,11 @@ def add_item_to_cart(client_id):
         if not item_exists:
             response = {'status': StatusCodes['not_found'],
                         'message': 'Item not found.'}
-            return flask.jsonify(response), response['status']
+            return json_response(response)
         if quantity < 0:
             response = {'status': StatusCodes['api_error'],
                         'message': '"quantity" must be greater than 0.'}
-            return flask.jsonify(response), response['status']
+            return json_response(response)
 
         cur.execute("INSERT INTO cartitem (quantity, item_item_id, shoppingcart_client_client_id) VALUES (%s, %s, %s)",
                     (quantity, item_id, client_id))
@@ -304,6 +489,7 @@ def add_item_to_cart(client_id):
                     'message': 'Item added to the shopping cart.'}
 
         conn.commit()
+        cart_cache.discard(client_id)
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(error)
@@ -315,7 +501,7 @@ def add_item_to_cart(client_id):
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 5. Get Items List: http://localhost:8080/proj/api/items (GET)
@@ -324,71 +510,84 @@ def add_item_to_cart(client_id):
 # ordenar por norme: http://localhost:8080/proj/api/items?sort=name
 # ordenar por preço: http://localhost:8080/proj/api/items?sort=price
 # ordenar por preço, 2a pagina 7 itens nela: http://localhost:8080/proj/api/items?sort=price&page=2&pageSize=7
+# só algumas colunas: http://localhost:8080/proj/api/items?fields=item_id,name,price
+# vários itens por id: http://localhost:8080/proj/api/items?ids=1246,1537,1348
 @app.route('/proj/api/items', methods=['GET'], strict_slashes=True)
 def get_items_list():
     logger.info('GET /proj/api/items')
-    conn = db_connection()
-    cur = conn.cursor()
 
-    try:
-        base_query = """SELECT item_id, name, category, price, stock, description, manufacturer, weight,
-                            image_url, total_unit_sales 
-                        FROM item"""
+    schema, error = project_fields(ITEM_SCHEMA, parse_fields(flask.request.args.get('fields')))
+    if error is not None:
+        return error
+
+    ids = flask.request.args.get('ids')
+    if ids is not None:
+        return get_items_by_ids(ids.split(','), schema)
 
-        page = flask.request.args.get('page', default=1, type=int)
-        limit = flask.request.args.get('limit', default=10, type=int)
-        category = flask.request.args.get('category')
-        sort = flask.request.args.get('sort')
+    page = flask.request.args.get('page', default=1, type=int)
+    limit = flask.request.args.get('limit', default=10, type=int)
+    category = flask.request.args.get('category')
+    sort = flask.request.args.get('sort')
 
-        if page <= 0 or limit <= 0:
+    if page <= 0 or limit <= 0:
+        response = {'status': StatusCodes['api_error'],
+                    'message': 'Page and page size parameters must be positive integers.'}
+        return json_response(response)
+
+    if sort and sort not in ['name', 'price']:
+        response = {'status': StatusCodes['api_error'],
+                    'message': 'The specified sorting option is not valid. Use "name" or "price".'}
+        return json_response(response)
+
+    offset = (page - 1) * limit
+
+    snapshot = catalog.fresh_snapshot()
+    if snapshot is not None:
+        if category and category not in snapshot.categories:
             response = {'status': StatusCodes['api_error'],
-                        'message': 'Page and page size parameters must be positive integers.'}
-            return flask.jsonify(response), response['status']
+                        'message': 'The specified category does not exist.'}
+            return json_response(response)
+
+        rows = snapshot.rows(snapshot.page(category or None, sort, offset, limit), schema.columns)
+        response = {'status': StatusCodes['success'],
+                    'message': 'Items retrieved successfully.',
+                    'data': schema.rows(rows)}
+        return json_response(response)
+
+    conn = get_db()
+    cur = conn.cursor()
+
+    try:
+        base_query = f"SELECT {schema.select_list()} FROM item"
+        params = []
 
         if category:
-            cur.execute("SELECT EXISTS (SELECT 1 FROM category WHERE category_id = %s)", (category,))
+            cur.execute("SELECT EXISTS (SELECT 1 FROM category WHERE name = %s)", (category,))
             category_exists = cur.fetchone()[0]
             if not category_exists:
                 response = {'status': StatusCodes['api_error'],
                             'message': 'The specified category does not exist.'}
-                return flask.jsonify(response), response['status']
+                return json_response(response)
 
-        if sort and sort not in ['name', 'price']:
-            response = {'status': StatusCodes['api_error'],
-                        'message': 'The specified sorting option is not valid. Use "name" or "price".'}
-            return flask.jsonify(response), response['status']
-
-        if category:
-            base_query += f" WHERE category_category_id = '{category}'"
+            base_query += " WHERE category = %s"
+            params.append(category)
 
+        # same orders as the catalog replica, so a page doesn't change depending on who served it
         if sort == 'name':
-            base_query += " ORDER BY name"
+            base_query += ' ORDER BY name COLLATE "C", item_id'
         elif sort == 'price':
-            base_query += " ORDER BY price"
-
-        offset = (page - 1) * limit
-        base_query += f" LIMIT {limit} OFFSET {offset}"
+            base_query += " ORDER BY price, item_id"
+        else:
+            base_query += " ORDER BY item_id"
 
-        cur.execute(base_query)
-        rows = cur.fetchall()
+        base_query += " LIMIT %s OFFSET %s"
+        params.extend([limit, offset])
 
-        response_data = []
-        for row in rows:
-            item = {'Item_ID': row[0],
-                    'Name': row[1],
-                    'Category': row[2],
-                    'Price': row[3],
-                    'Stock': row[4],
-                    'Description': row[5],
-                    'Manufacturer': row[6],
-                    'Weight': row[7],
-                    'Image_URL': row[8],
-                    'Total_Unit_Sales': row[9]}
-            response_data.append(item)
+        cur.execute(base_query, params)
 
         response = {'status': StatusCodes['success'],
                     'message': 'Items retrieved successfully.',
-                    'data': response_data}
+                    'data': schema.rows(cur.fetchall())}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /proj/api/items - error: {error}')
@@ -399,38 +598,50 @@ def get_items_list():
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 6. Get Item Details: http://localhost:8080/proj/api/items/{id} (GET)
 @app.route('/proj/api/items/<item_id>', methods=['GET'], strict_slashes=True)
 def get_item_details(item_id):
     logger.info(f'GET /proj/api/items/{item_id}')
-    conn = db_connection()
+
+    if not (item_id.isascii() and item_id.isdigit()) or int(item_id) > 2 ** 31 - 1:
+        # the item_id column is an INTEGER; this is also /proj/api/items/stream reaching the API instead of stream_app.py
+        response = {'status': StatusCodes['not_found'],
+                    'error': 'Item not found'}
+        return json_response(response)
+
+    schema, error = project_fields(ITEM_SCHEMA, parse_fields(flask.request.args.get('fields')))
+    if error is not None:
+        return error
+
+    snapshot = catalog.fresh_snapshot()
+    if snapshot is not None:
+        position = snapshot.get(int(item_id))
+        if position is None:
+            response = {'status': StatusCodes['not_found'],
+                        'error': 'Item not found'}
+        else:
+            response = {'status': StatusCodes['success'],
+                        'message': 'Item details retrieved successfully.',
+                        'data': schema.row(snapshot.rows([position], schema.columns)[0])}
+        return json_response(response)
+
+    conn = get_db()
     cur = conn.cursor()
 
     try:
-        cur.execute("SELECT * FROM item WHERE item_id = %s", (item_id,))
-        rows = cur.fetchall()
+        cur.execute(f"SELECT {schema.select_list()} FROM item WHERE item_id = %s", (item_id,))
+        row = cur.fetchone()
 
-        if len(rows) == 0:
+        if row is None:
             response = {'status': StatusCodes['not_found'],
                         'error': 'Item not found'}
         else:
-            row = rows[0]
-            response_data = {'Item_ID': row[0],
-                             'Name': row[1],
-                             'Category': row[2],
-                             'Price': row[3],
-                             'Stock': row[4],
-                             'Description': row[5],
-                             'Manufacturer': row[6],
-                             'Weight': row[7],
-                             'Image_URL': row[8]}
-
             response = {'status': StatusCodes['success'],
                         'message': 'Item details retrieved successfully.',
-                        'data': response_data}
+                        'data': schema.row(row)}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /proj/api/items/{item_id} - error: {error}')
@@ -440,7 +651,7 @@ def get_item_details(item_id):
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 7. Search Items: http://localhost:8080/proj/api/items/search/{item_name} (GET)
@@ -448,37 +659,25 @@ def get_item_details(item_id):
 def search_items(search):
     logger.info('GET /proj/api/items/search')
 
-    conn = db_connection()
+    schema, error = project_fields(ITEM_SCHEMA, parse_fields(flask.request.args.get('fields')))
+    if error is not None:
+        return error
+
+    conn = get_db()
     cur = conn.cursor()
 
     try:
-        cur.execute("SELECT * FROM item WHERE lower(name) LIKE lower(%s)", ('%' + search + '%',))
+        cur.execute(f"SELECT {schema.select_list()} FROM item WHERE lower(name) LIKE lower(%s)",
+                    ('%' + search + '%',))
         rows = cur.fetchall()
 
-        logger.debug('GET /proj/api/items/search - parse')
-
         if not rows:
             response = {'status': StatusCodes['not_found'],
                         'message': "No items found for the given search criteria."}
         else:
-            response_data = []
-            for row in rows:
-                logger.debug(row)
-                content = {'Item_ID': row[0],
-                           'Name': row[1],
-                           'Category': row[2],
-                           'Price': row[3],
-                           'Stock': row[4],
-                           'Description': row[5],
-                           'Manufacturer': row[6],
-                           'Weight': row[7],
-                           'Image_URL': row[8]}
-
-                response_data.append(content)
-
             response = {'status': StatusCodes['success'],
                         'message': "Items retrieved successfully.",
-                        'data': response_data}
+                        'data': schema.rows(rows)}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /proj/api/items/search - error: {error}')
@@ -489,14 +688,14 @@ def search_items(search):
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response)
+    return json_response(response)
 
 
 # 8. Get Top 3 Sales per Category: http://localhost:8080/proj/api/stats/sales (GET)
 @app.route('/proj/api/stats/sales', methods=['GET'], strict_slashes=True)
 def get_top_sales_per_category():
     logger.info('GET /proj/api/stats/sales')
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     try:
@@ -542,21 +741,26 @@ def get_top_sales_per_category():
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 9. Purchase Items: http://localhost:8080/proj/api/purchase (POST)
+# body: {"client_id": "client101", "cart": [{"item_id": 1537, "quantity": 1}]}
+# ou, para comprar o carrinho guardado na base de dados: {"client_id": "client101", "from_cart": true}
 @app.route('/proj/api/purchase', methods=['POST'], strict_slashes=True)
 def purchase_items():
     logger.info('POST /proj/api/purchase')
     payload = flask.request.get_json()
 
+    if payload.get('from_cart') is True and 'client_id' in payload:
+        return checkout_server_cart(payload['client_id'])
+
     if 'cart' not in payload or 'client_id' not in payload:
         response = {'status': StatusCodes['api_error'],
                     'message': 'Invalid request payload'}
-        return flask.jsonify(response), response['status']
+        return json_response(response)
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     try:
@@ -569,7 +773,7 @@ def purchase_items():
         if cur.fetchone() is None:
             response = {'status': StatusCodes['not_found'],
                         'message': f'Shopping cart not found for client: {client_id}'}
-            return flask.jsonify(response), response['status']
+            return json_response(response)
 
         for item in payload['cart']:
             item_id, quantity = item['item_id'], item['quantity']
@@ -577,7 +781,7 @@ def purchase_items():
             if quantity < 0:
                 response = {'status': StatusCodes['api_error'],
                             'message': '"quantity" must be greater than 0.'}
-                return flask.jsonify(response), response['status']
+                return json_response(response)
 
             cur.execute('SELECT stock, price FROM item WHERE item_id = %s', (item_id,))
             row = cur.fetchone()
@@ -585,14 +789,14 @@ def purchase_items():
             if row is None:
                 response = {'status': StatusCodes['not_found'],
                             'message': f'Item not found: {item_id}'}
-                return flask.jsonify(response), response['status']
+                return json_response(response)
 
             stock, price = row
 
             if quantity > stock:
                 response = {'status': StatusCodes['api_error'],
                             'message': f'Insufficient stock for item {item_id}'}
-                return flask.jsonify(response), response['status']
+                return json_response(response)
 
             new_stock = stock - quantity
             cur.execute('UPDATE item SET stock = %s WHERE item_id = %s', (new_stock, item_id))
@@ -607,6 +811,7 @@ def purchase_items():
         response = {'status': StatusCodes['success'],
                     'message': 'Purchase successful',
                     'data': {'total_price': total_price, 'order_id': order_id}}
+        cart_cache.discard(client_id)
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'POST /proj/api/purchase - error: {error}')
@@ -619,23 +824,106 @@ def purchase_items():
             #conn.autocommit = True
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
+
+
+def checkout_server_cart(client_id):
+    conn = get_db()
+    cur = conn.cursor()
+
+    try:
+        # locking the cart row serializes concurrent checkouts of the same cart
+        cur.execute('SELECT 1 FROM shoppingcart WHERE client_client_id = %s FOR UPDATE', (client_id,))
+        if cur.fetchone() is None:
+            response = {'status': StatusCodes['not_found'],
+                        'message': f'Shopping cart not found for client: {client_id}'}
+            return json_response(response)
+
+        # lock the stock rows, always in item_id order so two checkouts can't deadlock
+        cur.execute("""SELECT item.item_id
+                       FROM item
+                       JOIN cartitem ON item.item_id = cartitem.item_item_id
+                       WHERE cartitem.shoppingcart_client_client_id = %s
+                       ORDER BY item.item_id
+                       FOR UPDATE OF item""", (client_id,))
+
+        cur.execute("""SELECT COUNT(*),
+                              COALESCE(SUM(cartitem.quantity * item.price), 0),
+                              array_agg(item.item_id ORDER BY item.item_id)
+                                  FILTER (WHERE cartitem.quantity > item.stock OR cartitem.quantity < 0)
+                       FROM cartitem
+                       JOIN item ON cartitem.item_item_id = item.item_id
+                       WHERE cartitem.shoppingcart_client_client_id = %s""", (client_id,))
+        lines, total_price, unavailable = cur.fetchone()
+
+        if lines == 0:
+            response = {'status': StatusCodes['api_error'],
+                        'message': 'The shopping cart is empty.'}
+            return json_response(response)
+
+        if unavailable:
+            response = {'status': StatusCodes['api_error'],
+                        'message': f"Insufficient stock for items {', '.join(map(str, unavailable))}"}
+            return json_response(response)
+
+        cur.execute("""UPDATE item
+                       SET stock = item.stock - cartitem.quantity
+                       FROM cartitem
+                       WHERE cartitem.item_item_id = item.item_id
+                         AND cartitem.shoppingcart_client_client_id = %s""", (client_id,))
+
+        cur.execute('''INSERT INTO purchase (total_price, order_date, client_client_id)
+                       VALUES (%s, NOW(), %s)
+                       RETURNING order_id''', (total_price, client_id))
+        order_id = cur.fetchone()[0]
+
+        cur.execute("""INSERT INTO purchaseitem (quantity, purchase_order_id, item_item_id)
+                       SELECT quantity, %s, item_item_id
+                       FROM cartitem
+                       WHERE shoppingcart_client_client_id = %s""", (order_id, client_id))
+
+        cur.execute("DELETE FROM cartitem WHERE shoppingcart_client_client_id = %s RETURNING item_item_id",
+                    (client_id,))
+        bought = [row[0] for row in cur.fetchall()]
+
+        conn.commit()
+        cart_cache.discard(client_id)
+        record_order(order_id, bought)
+
+        response = {'status': StatusCodes['success'],
+                    'message': 'Purchase successful',
+                    'data': {'total_price': total_price, 'order_id': order_id, 'items': lines}}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /proj/api/purchase - error: {error}')
+        conn.rollback()
+        response = {'status': StatusCodes['internal_error'],
+                    'message': str(error)}
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return json_response(response)
 
 
 # 10. Get Clients with Filters: http://localhost:8080/proj/api/clients (GET)
 @app.route('/proj/api/clients', methods=['GET'], strict_slashes=True)
 def get_clients_with_filters():
     logger.info('GET /proj/api/clients')
-    conn = db_connection()
+
+    schema, error = project_fields(CLIENT_SCHEMA, parse_fields(flask.request.args.get('fields')))
+    if error is not None:
+        return error
+
+    conn = get_db()
     cur = conn.cursor()
 
     try:
         last_purchase_date = flask.request.args.get('last_purchase_date', type=str)
         item_bought = flask.request.args.get('item_bought', type=str)
 
-        base_query = """SELECT client.client_id, client.name, client.email,
-                                MAX(purchase.order_date) AS last_purchase_date,
-                                MAX(item.name) AS last_item_bought
+        base_query = f"""SELECT {schema.select_list()}
                          FROM client
                          LEFT JOIN purchase ON client.client_id = purchase.client_client_id
                          LEFT JOIN purchaseitem ON purchase.order_id = purchaseitem.purchase_order_id
@@ -655,23 +943,13 @@ def get_clients_with_filters():
             base_query += " WHERE " + " AND ".join(where_conditions)
 
         base_query += """ GROUP BY client.client_id, client.name, client.email
-                          ORDER BY last_purchase_date DESC NULLS LAST"""
+                          ORDER BY MAX(purchase.order_date) DESC NULLS LAST"""
 
         cur.execute(base_query, tuple(params))
-        rows = cur.fetchall()
-
-        results = []
-        for row in rows:
-            client = {'id': row[0],
-                      'name': row[1],
-                      'email': row[2],
-                      'last_purchase_date': row[3].isoformat() if row[3] else None,
-                      'last_item_bought': row[4]}
-            results.append(client)
 
         response = {'status': StatusCodes['success'],
                     'message': 'Clients retrieved successfully.',
-                    'data': results}
+                    'data': schema.rows(cur.fetchall())}
 
     except (Exception, psycopg2.DatabaseError) as error:
         logger.error(f'GET /proj/api/clients - error: {error}')
@@ -682,7 +960,7 @@ def get_clients_with_filters():
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 11. Add Client: http://localhost:8080/proj/api/clients (POST)
@@ -691,7 +969,7 @@ def add_client():
     logger.info('POST /proj/api/clients')
     payload = flask.request.get_json()
 
-    conn = db_connection()
+    conn = get_db()
     cur = conn.cursor()
 
     try:
@@ -699,7 +977,7 @@ def add_client():
         if not set(required_fields).issubset(set(payload.keys())):
             response = {'status': StatusCodes['api_error'],
                         'message': 'Missing required fields in the request body.'}
-            return flask.jsonify(response), response['status']
+            return json_response(response)
 
         client_name, client_email = payload['name'], payload['email']
 
@@ -729,14 +1007,23 @@ def add_client():
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response['status']
+    return json_response(response)
 
 
 # 12. Get Client Orders: http://localhost:8080/proj/api/clients/{client_id}/orders (GET)
+# sem as linhas da encomenda: http://localhost:8080/proj/api/clients/{client_id}/orders?fields=order_id,total_price
 @app.route('/proj/api/clients/<client_id>/orders', methods=['GET'], strict_slashes=True)
 def get_client_orders(client_id):
     logger.info(f'GET /proj/api/clients/{client_id}/orders')
-    conn = db_connection()
+
+    # "items" selects the order lines, every other name is an order column
+    fields = parse_fields(flask.request.args.get('fields'))
+    with_items = fields is None or 'items' in fields
+    schema, error = project_fields(ORDER_SCHEMA, fields - {'items'} if fields else None)
+    if error is not None:
+        return error
+
+    conn = get_db()
     cur = conn.cursor()
 
     try:
@@ -746,14 +1033,18 @@ def get_client_orders(client_id):
         if not client_exists:
             response = {'status': StatusCodes['not_found'],
                         'message': 'Client not found.'}
-            return flask.jsonify(response), response['status']
+            return json_response(response)
 
-        cur.execute("""SELECT purchase.order_id, purchase.total_price, purchase.order_date,
-                              purchaseitem.quantity, item.item_id
-                       FROM purchase
-                       JOIN purchaseitem ON purchase.order_id = purchaseitem.purchase_order_id
-                       JOIN item ON purchaseitem.item_item_id = item.item_id
-                       WHERE purchase.client_client_id = %s """, (client_id,))
+        # the order id always comes first, it is the grouping key even when it was not requested
+        select_list = ', '.join(['purchase.order_id'] + list(schema.columns) +
+                                (list(ORDER_ITEM_SCHEMA.columns) if with_items else []))
+        join = "JOIN purchaseitem ON purchase.order_id = purchaseitem.purchase_order_id" if with_items else ""
+
+        cur.execute(f"""SELECT {select_list}
+                        FROM purchase
+                        {join}
+                        WHERE purchase.client_client_id = %s
+                        ORDER BY purchase.order_id""", (client_id,))
 
         rows = cur.fetchall()
 
@@ -761,13 +1052,16 @@ def get_client_orders(client_id):
             response = {'status': StatusCodes['not_found'],
                         'message': 'Client has no orders.'}
         else:
+            split = len(schema.keys) + 1
             orders = {}
             for row in rows:
-                order_id, total_price, order_date, item_id, quantity = row
-                if order_id not in orders:
-                    orders[order_id] = {'order_id': order_id, 'total_price': total_price, 'order_date': order_date,
-                                        'items': []}
-                orders[order_id]['items'].append({'item_id': item_id, 'quantity': quantity})
+                order = orders.get(row[0])
+                if order is None:
+                    order = orders[row[0]] = schema.row(row[1:split])
+                    if with_items:
+                        order['items'] = []
+                if with_items:
+                    order['items'].append(ORDER_ITEM_SCHEMA.row(row[split:]))
 
             response_data = {'status': StatusCodes['success'],
                              'message': 'Client orders retrieved successfully.',
@@ -783,13 +1077,350 @@ def get_client_orders(client_id):
         if conn is not None:
             conn.close()
 
-    return flask.jsonify(response), response["status"]
+    return json_response(response)
 
 
-if __name__ == '__main__':
+# 13. Export Data: http://localhost:8080/proj/api/export (POST)
+# body (opcional): {"tables": ["purchase", "orders"], "format": "parquet", "full": false}
+# corre em segundo plano, a resposta traz o job_id para consultar em 13a
+@app.route('/proj/api/export', methods=['POST'], strict_slashes=True)
+def export_tables():
+    logger.info('POST /proj/api/export')
+    payload = flask.request.get_json(silent=True) or {}
 
+    import export_data  # pandas is only imported when an export runs
+
+    try:
+        fmt = payload.get('format', 'parquet')
+        tables = export_data.validate(payload.get('tables'), fmt)
+        lock = export_data.acquire_lock(export_data.EXPORT_DIR)
+    except ValueError as error:
+        response = {'status': StatusCodes['api_error'],
+                    'message': str(error)}
+        return json_response(response)
+    except export_data.ExportInProgress as error:
+        response = {'status': StatusCodes['conflict'],
+                    'message': str(error)}
+        return json_response(response)
+
+    job_id = uuid.uuid4().hex
+    threading.Thread(target=export_data.run_job, name=f'export-{job_id}', daemon=True,
+                     args=(job_id, tables, export_data.EXPORT_DIR, fmt, not payload.get('full', False), lock)).start()
+
+    response = {'status': StatusCodes['accepted'],
+                'message': 'Export started.',
+                'data': {'job_id': job_id}}
+    return json_response(response)
+
+
+# 13a. Get Export Job: http://localhost:8080/proj/api/export/{job_id} (GET)
+@app.route('/proj/api/export/<job_id>', methods=['GET'], strict_slashes=True)
+def get_export_job(job_id):
+    logger.info(f'GET /proj/api/export/{job_id}')
+
+    import export_data
+
+    job = export_data.load_job(export_data.EXPORT_DIR, job_id)
+    if job is None:
+        response = {'status': StatusCodes['not_found'],
+                    'message': 'Export job not found.'}
+    else:
+        response = {'status': StatusCodes['success'],
+                    'message': f"Export job {job['status']}.",
+                    'data': job}
+    return json_response(response)
+
+
+# 14. Get Items by IDs: http://localhost:8080/proj/api/items/batch (POST)
+# body: {"ids": [1246, 1537, 1348]}, para listas longas demais para ?ids=
+@app.route('/proj/api/items/batch', methods=['POST'], strict_slashes=True)
+def get_items_batch():
+    logger.info('POST /proj/api/items/batch')
+    payload = flask.request.get_json(silent=True) or {}
+
+    if not isinstance(payload, dict) or not isinstance(payload.get('ids'), list):
+        response = {'status': StatusCodes['api_error'],
+                    'message': 'Request body must contain an "ids" list.'}
+        return json_response(response)
+
+    schema, error = project_fields(ITEM_SCHEMA, parse_fields(payload.get('fields') or flask.request.args.get('fields')))
+    if error is not None:
+        return error
+
+    return get_items_by_ids(payload['ids'], schema)
+
+
+def get_items_by_ids(ids, schema):
+    try:
+        # only ints and strings: int() would also take true or truncate 12.7, and raises TypeError for null
+        if any(isinstance(item_id, bool) or not isinstance(item_id, (int, str)) for item_id in ids):
+            raise TypeError('not an integer')
+        # dict.fromkeys drops repeated ids but keeps the requested order
+        ids = list(dict.fromkeys(int(item_id) for item_id in ids if str(item_id).strip()))
+    except (TypeError, ValueError):
+        response = {'status': StatusCodes['api_error'],
+                    'message': 'Item IDs must be integers.'}
+        return json_response(response)
+
+    if not ids or len(ids) > MAX_ITEMS_BATCH:
+        response = {'status': StatusCodes['api_error'],
+                    'message': f'Between 1 and {MAX_ITEMS_BATCH} item IDs must be requested.'}
+        return json_response(response)
+
+    conn = get_db()
+    cur = conn.cursor()
+
+    try:
+        # item_id always comes first so rows can be put back in the requested order
+        cur.execute(f"SELECT item_id, {schema.select_list()} FROM item WHERE item_id = ANY(%s)", (ids,))
+        found = {row[0]: schema.row(row[1:]) for row in cur.fetchall()}
+
+        response = {'status': StatusCodes['success'],
+                    'message': 'Items retrieved successfully.',
+                    'data': [found[item_id] for item_id in ids if item_id in found],
+                    'missing': [item_id for item_id in ids if item_id not in found]}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /proj/api/items?ids - error: {error}')
+        response = {'status': StatusCodes['internal_error'],
+                    'message': str(error)}
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return json_response(response)
+
+
+# 15. Get Cart: http://localhost:8080/proj/api/cart/{client_id} (GET)
+@app.route('/proj/api/cart/<client_id>', methods=['GET'], strict_slashes=True)
+def get_cart(client_id):
+    logger.info(f'GET /proj/api/cart/{client_id}')
+
+    cart = cart_cache.get(client_id) if cart_cache_usable() else None
+    if cart is not None:
+        response = {'status': StatusCodes['success'],
+                    'message': 'Cart retrieved successfully.',
+                    'data': cart}
+        return json_response(response)
+
+    version = cart_cache.version()  # taken before the read, see LRUCache
+    conn = get_db()
+    cur = conn.cursor()
+
+    try:
+        cached = listener.is_alive_within(CART_CACHE_MAX_LAG)
+        if cached and not cart_cache_usable():
+            cached = check_cart_triggers(cur)
+
+        # LEFT JOINs from shoppingcart: no row means no cart, a row of NULLs means an empty cart
+        cur.execute(f"""SELECT {CART_LINE_SCHEMA.select_list()}
+                        FROM shoppingcart
+                        LEFT JOIN cartitem ON shoppingcart.client_client_id = cartitem.shoppingcart_client_client_id
+                        LEFT JOIN item ON cartitem.item_item_id = item.item_id
+                        WHERE shoppingcart.client_client_id = %s
+                        ORDER BY item.name""", (client_id,))
+        rows = cur.fetchall()
+
+        if not rows:
+            response = {'status': StatusCodes['not_found'],
+                        'message': 'Cart not found.'}
+        else:
+            lines = CART_LINE_SCHEMA.rows(row for row in rows if row[0] is not None)
+            cart = {'client_id': client_id,
+                    'items': lines,
+                    'total': sum(line['line_total'] for line in lines)}
+            if cached:
+                cart_cache.set(client_id, cart, version)
+
+            response = {'status': StatusCodes['success'],
+                        'message': 'Cart retrieved successfully.',
+                        'data': cart}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'GET /proj/api/cart/{client_id} - error: {error}')
+        response = {'status': StatusCodes['internal_error'],
+                    'message': str(error)}
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return json_response(response)
+
+
+# 16. Get Related Items: http://localhost:8080/proj/api/items/{item_id}/related (GET)
+# os 5 itens mais comprados em conjunto: http://localhost:8080/proj/api/items/1449/related?limit=5
+@app.route('/proj/api/items/<int:item_id>/related', methods=['GET'], strict_slashes=True)
+def get_related_items(item_id):
+    logger.info(f'GET /proj/api/items/{item_id}/related')
+    limit = flask.request.args.get('limit', default=RECOMMENDER_TOP_K, type=int)
+
+    if limit <= 0:
+        response = {'status': StatusCodes['api_error'],
+                    'message': 'The limit must be a positive integer.'}
+        return json_response(response)
+
+    current = recommender
+    if current is None:
+        # not built yet (or the builds keep failing), maintain_recommender keeps trying in the background
+        retry_after = RECOMMENDER_RETRY
+        if recommender_next_build is not None:
+            retry_after = max(recommender_next_build - time.monotonic(), 1)
+        response = {'status': StatusCodes['unavailable'],
+                    'message': 'Recommendations are not available yet, try again shortly.'}
+        return json_response(response, headers={'Retry-After': str(math.ceil(retry_after))})
+
+    related = [{'item_id': related_id, 'times_bought_together': count}
+               for related_id, count in current.related(item_id, limit)]
+
+    response = {'status': StatusCodes['success'],
+                'message': 'Related items retrieved successfully.',
+                'data': related}
+    return json_response(response)
+
+
+def record_order(order_id, item_ids):
+    with recommender_swap:
+        if recommender_pending is not None:
+            recommender_pending.append((order_id, item_ids))
+        current = recommender
+    if current is not None:
+        current.add_order(item_ids)
+
+
+def maintain_recommender():
+    """Builds the recommender, then rebuilds it every RECOMMENDER_REFRESH seconds. A failed build is
+    retried after RECOMMENDER_RETRY seconds, twice as long after every further failure."""
+    global recommender_next_build
+    delay = RECOMMENDER_RETRY
+    while True:
+        if refresh_recommender():
+            delay = RECOMMENDER_RETRY
+            wait = RECOMMENDER_REFRESH
+        else:
+            wait, delay = delay, min(delay * 2, RECOMMENDER_REFRESH)
+        recommender_next_build = time.monotonic() + wait
+        time.sleep(wait)
+
+
+def refresh_recommender():
+    """Rebuilds the recommender from the purchaseitem table, returns whether it worked."""
+    global recommender, recommender_pending
+    if not recommender_refresh.acquire(blocking=False):
+        return False  # another thread is already rebuilding it
+
+    conn = None
+    try:
+        from recommendations import CoPurchaseRecommender
+
+        # started before the SELECT, an order is then either in its result or in recommender_pending
+        with recommender_swap:
+            recommender_pending = []
+
+        conn = db_connection()
+        cur = conn.cursor()
+        cur.execute("SELECT purchase_order_id, item_item_id FROM purchaseitem")
+        order_lines = cur.fetchall()
+        fresh = CoPurchaseRecommender(top_k=RECOMMENDER_TOP_K)
+        fresh.build(order_lines)
+
+        seen = {order_id for order_id, _ in order_lines}
+        with recommender_swap:
+            for order_id, item_ids in recommender_pending:
+                if order_id not in seen:
+                    fresh.add_order(item_ids)
+            recommender = fresh
+        return True
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'Recommendations rebuild - error: {error}')
+        return False
+
+    finally:
+        with recommender_swap:
+            recommender_pending = None
+        if conn is not None:
+            conn.close()
+        recommender_refresh.release()
+
+
+# 17. Get Metrics: http://localhost:8080/proj/api/admin/metrics (GET)
+@app.route('/proj/api/admin/metrics', methods=['GET'], strict_slashes=True)
+def get_metrics():
+    response = {'status': StatusCodes['success'],
+                'message': 'Metrics retrieved successfully.',
+                'data': {'counters': metrics.snapshot(),
+                         'circuit_breaker': breaker.state,
+                         'db_gate': {'limit': db_gate.limit,
+                                     'threads': api_threads(),
+                                     'engaged': db_gate.limit < api_threads()}}}
+    return json_response(response)
+
+
+# 18. Get Slowest Queries: http://localhost:8080/proj/api/admin/slow-queries (GET)
+# as 5 com maior tempo médio: http://localhost:8080/proj/api/admin/slow-queries?limit=5&sort=mean_ms
+@app.route('/proj/api/admin/slow-queries', methods=['GET'], strict_slashes=True)
+def get_slow_queries():
+    limit = flask.request.args.get('limit', default=10, type=int)
+    sort = flask.request.args.get('sort', default='total_ms')
+
+    if sort not in ('total_ms', 'mean_ms', 'max_ms', 'calls', 'slow_calls', 'errors'):
+        response = {'status': StatusCodes['api_error'],
+                    'message': 'The sort must be one of total_ms, mean_ms, max_ms, calls, slow_calls or errors.'}
+        return json_response(response)
+
+    response = {'status': StatusCodes['success'],
+                'message': 'Slowest queries retrieved successfully.',
+                'data': {'threshold_ms': slow_query_log.threshold_ms,
+                         'queries': slow_query_log.top(limit, sort)}}
+    return json_response(response)
+
+
+# 19. Bulk Update Prices and Stock: http://localhost:8080/proj/api/items/bulk (POST)
+# corpo CSV (Content-Type: text/csv) com cabeçalho item_id,price,stock
+# ou NDJSON (Content-Type: application/x-ndjson), uma linha {"item_id": 1246, "price": 45.99, "stock": 80} por item
+@app.route('/proj/api/items/bulk', methods=['POST'], strict_slashes=True)
+def bulk_update_items():
+    logger.info('POST /proj/api/items/bulk')
+    fmt = 'ndjson' if 'ndjson' in (flask.request.mimetype or '') else 'csv'
+
+    conn = get_db()
+
+    try:
+        result = apply_feed(conn, flask.request.stream, fmt)
+        conn.commit()
+
+        if result['prices_changed']:
+            cart_cache.clear()
+
+        response = {'status': StatusCodes['success'],
+                    'message': 'Feed applied successfully.',
+                    'data': result}
+
+    except (ValueError, psycopg2.DataError) as error:
+        conn.rollback()
+        response = {'status': StatusCodes['api_error'],
+                    'message': str(error)}
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'POST /proj/api/items/bulk - error: {error}')
+        conn.rollback()
+        response = {'status': StatusCodes['internal_error'],
+                    'message': str(error)}
+
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return json_response(response)
+
+
+def setup_logging():
+    # creates log_file.log, so it is called by init_worker and not when the module is imported
+    if logger.handlers:
+        return
     logging.basicConfig(filename='log_file.log')
-    logger = logging.getLogger('logger')
     logger.setLevel(logging.DEBUG)
     ch = logging.StreamHandler()
     ch.setLevel(logging.DEBUG)
@@ -798,7 +1429,37 @@ if __name__ == '__main__':
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
-    host = '127.0.0.1'
-    port = 8080
-    app.run(host=host, debug=True, threaded=True, port=port)
-    logger.info(f'API v1.0 online: http://{host}:{port}')
\ No newline at end of file
+
+# the handlers use the logger, so it has to exist when the app is imported by a WSGI server too
+logger = logging.getLogger('logger')
+
+
+def init_worker():
+    """Per-process initialization, called by gunicorn in every worker after the fork.
+
+    Nothing that holds sockets, threads or caches may be created at import time, otherwise
+    it would be shared by all the forked workers.
+    """
+    setup_logging()
+    # built in the background, the worker can take requests meanwhile
+    threading.Thread(target=maintain_recommender, name='recommender', daemon=True).start()
+
+    check_db_gate()
+    listener.start()  # listening before the catalog load, so no change can slip in between
+
+    if CATALOG_REPLICA:
+        # loads in the background, the handlers use Postgres until fresh_snapshot() returns it
+        catalog.start()
+
+    logger.info(f'Worker {os.getpid()} ready')
+
+
+if __name__ == '__main__':
+    # development server; in production use: gunicorn -c gunicorn.conf.py api:app
+    host = setting('API_HOST', '127.0.0.1')
+    port = setting('API_PORT', 8080, int)
+    debug = setting('API_DEBUG', '1') == '1'
+
+    init_worker()
+    logger.info(f'API v1.0 online: http://{host}:{port}')
+    app.run(host=host, debug=debug, threaded=True, port=port)
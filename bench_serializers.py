@@ -0,0 +1,51 @@
+import json
+import time
+import decimal
+import argparse
+from serializers import ITEM_SCHEMA, dumps
+
+
+def make_rows(n):
+    return [(i, f'Item {i}', 'Toys', decimal.Decimal('19.99'), 100, 'Interactive tunnel for cats',
+             'PlayfulPets Inc.', 1.2, f'https://example.com/item-{i}.jpg', 8) for i in range(n)]
+
+
+def positional(rows):
+    # what the handlers did before: positional dicts + the standard library encoder used by flask.jsonify
+    data = []
+    for row in rows:
+        data.append({'Item_ID': row[0],
+                     'Name': row[1],
+                     'Category': row[2],
+                     'Price': row[3],
+                     'Stock': row[4],
+                     'Description': row[5],
+                     'Manufacturer': row[6],
+                     'Weight': row[7],
+                     'Image_URL': row[8],
+                     'Total_Unit_Sales': row[9]})
+    return json.dumps({'status': 200, 'data': data}, default=float).encode()
+
+
+def schema(rows):
+    return dumps({'status': 200, 'data': ITEM_SCHEMA.rows(rows)})
+
+
+def bench(fn, rows, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(rows)
+        best = min(best, time.perf_counter() - start)
+    return best / len(rows) * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-row cost of serializing an item page.')
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    for name, fn in (('positional + json', positional), ('schema + dumps', schema)):
+        print(f'{name:20s} {bench(fn, rows, args.repeat):.3f} us/row')
@@ -0,0 +1,148 @@
+import io
+import sys
+import json
+import argparse
+import psycopg2
+from db import db_connection
+
+FEED_COLUMNS = ('item_id', 'price', 'stock')
+UNMATCHED_SAMPLE = 100
+
+
+class NDJSONReader(io.RawIOBase):
+    """Turns NDJSON lines into CSV on the fly, as a file COPY can read from.
+
+    psycopg2 turns an exception raised while COPY reads into a generic error, the ValueError of
+    an invalid line is kept in `error`.
+    """
+
+    def __init__(self, lines):
+        self.error = None
+        self._rows = self._encode(lines)
+        self._buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self._buffer) < len(b):
+            try:
+                row = next(self._rows, None)
+            except ValueError as error:
+                self.error = error
+                raise
+            if row is None:
+                break
+            self._buffer += row
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def _encode(self, lines):
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                values = (int(record['item_id']),
+                          None if record.get('price') is None else float(record['price']),
+                          None if record.get('stock') is None else int(record['stock']))
+            except (ValueError, KeyError, TypeError) as error:
+                raise ValueError(f'Invalid feed line {number}: {error}')
+            # an unquoted empty field is NULL for COPY ... CSV
+            yield (','.join('' if value is None else str(value) for value in values) + '\n').encode()
+
+
+def apply_feed(conn, stream, fmt='csv'):
+    """Loads a price/stock feed into a temp table with COPY and applies it with one UPDATE ... FROM.
+
+    `stream` is a binary file-like object. A CSV feed needs a header naming item_id and any of
+    price and stock; an empty price/stock (or a missing NDJSON key) leaves that column unchanged.
+    Runs in the caller's transaction, the caller commits. When an item appears more than once
+    the last row wins, as it would had the rows been applied one after the other.
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TEMP TABLE item_feed_rows (item_id INTEGER, price REAL, stock INTEGER) ON COMMIT DROP")
+
+    if fmt == 'csv':
+        header = [column.strip().lower() for column in stream.readline().decode().split(',')]
+        if 'item_id' not in header or not set(header) <= set(FEED_COLUMNS):
+            raise ValueError(f"The CSV header must have item_id and any of price, stock; got: {', '.join(header)}")
+        cur.copy_expert(f"COPY item_feed_rows ({', '.join(header)}) FROM STDIN WITH (FORMAT csv)", stream)
+    elif fmt == 'ndjson':
+        reader = NDJSONReader(stream)
+        try:
+            cur.copy_expert(f"COPY item_feed_rows ({', '.join(FEED_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", reader)
+        except psycopg2.Error:
+            if reader.error is not None:
+                raise reader.error from None
+            raise
+    else:
+        raise ValueError(f"Unknown feed format '{fmt}'. Use csv or ndjson.")
+
+    cur.execute("SELECT COUNT(*), COUNT(*) FILTER (WHERE price < 0 OR stock < 0) FROM item_feed_rows")
+    rows, invalid = cur.fetchone()
+    if invalid:
+        raise ValueError(f'{invalid} feed rows have a negative price or stock, nothing was applied.')
+
+    # one row per item, otherwise UPDATE ... FROM would apply an arbitrary one of them
+    cur.execute("""CREATE TEMP TABLE item_feed ON COMMIT DROP AS
+                   SELECT DISTINCT ON (item_id) item_id, price, stock
+                   FROM item_feed_rows
+                   ORDER BY item_id, ctid DESC""")
+    items = cur.rowcount
+    cur.execute("ANALYZE item_feed")
+
+    # rows that would not change anything are skipped, so they are not rewritten (nor notified)
+    cur.execute("""UPDATE item
+                   SET price = COALESCE(item_feed.price, item.price),
+                       stock = COALESCE(item_feed.stock, item.stock)
+                   FROM item_feed
+                   WHERE item.item_id = item_feed.item_id
+                     AND (item.price IS DISTINCT FROM COALESCE(item_feed.price, item.price)
+                          OR item.stock IS DISTINCT FROM COALESCE(item_feed.stock, item.stock))""")
+    changed = cur.rowcount
+
+    unmatched_query = """FROM item_feed
+                         WHERE NOT EXISTS (SELECT 1 FROM item WHERE item.item_id = item_feed.item_id)"""
+    cur.execute(f"SELECT COUNT(*) {unmatched_query}")
+    unmatched = cur.fetchone()[0]
+    cur.execute(f"SELECT item_feed.item_id {unmatched_query} ORDER BY item_feed.item_id LIMIT %s", (UNMATCHED_SAMPLE,))
+    unmatched_ids = [row[0] for row in cur.fetchall()]
+
+    cur.execute("SELECT COUNT(*) FILTER (WHERE price IS NOT NULL) > 0 FROM item_feed")
+    prices_changed = changed > 0 and cur.fetchone()[0]
+
+    return {'rows': rows,
+            'duplicates': rows - items,
+            'changed': changed,
+            'unchanged': items - changed - unmatched,
+            'unmatched': unmatched,
+            'unmatched_ids': unmatched_ids,
+            'prices_changed': prices_changed}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply a supplier price/stock feed to the item table.')
+    parser.add_argument('feed', help='CSV or NDJSON file, - for stdin')
+    parser.add_argument('--format', choices=['csv', 'ndjson'],
+                        help='feed format (default: from the file extension, csv for stdin)')
+    args = parser.parse_args()
+
+    fmt = args.format or ('ndjson' if args.feed.endswith(('.ndjson', '.jsonl')) else 'csv')
+    stream = sys.stdin.buffer if args.feed == '-' else open(args.feed, 'rb')
+
+    conn = db_connection()
+    try:
+        result = apply_feed(conn, stream, fmt)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        stream.close()
+
+    print(f"{result['rows']} rows ({result['duplicates']} repeated items): {result['changed']} changed, "
+          f"{result['unchanged']} unchanged, {result['unmatched']} unmatched")
@@ -0,0 +1,213 @@
+import json
+import time
+import uuid
+import logging
+import threading
+import psycopg2
+from serializers import ITEM_SCHEMA
+
+logger = logging.getLogger('logger')
+
+COLUMNS = ITEM_SCHEMA.columns
+SORTS = {
+    None: lambda columns, i: columns['item_id'][i],
+    # code point order, the database path sorts names with COLLATE "C" to match it
+    'name': lambda columns, i: (columns['name'][i], columns['item_id'][i]),
+    # NULL prices last, like ORDER BY price
+    'price': lambda columns, i: (columns['price'][i] is None, columns['price'][i] or 0, columns['item_id'][i]),
+}
+
+
+class CatalogSnapshot:
+    """Immutable copy of the item table, stored by column.
+
+    `orders` holds the precomputed row orders for every (category, sort) pair the items list
+    supports, category None being the whole catalog. Readers never lock: a change builds a new
+    snapshot and swaps the reference.
+    """
+    __slots__ = ('columns', 'position', 'categories', 'orders', 'loaded_at')
+
+    def __init__(self, rows, categories, loaded_at):
+        rows = sorted(rows, key=lambda row: row[0])
+        self.columns = {column: [row[i] for row in rows] for i, column in enumerate(COLUMNS)}
+        self.position = {item_id: i for i, item_id in enumerate(self.columns['item_id'])}
+        self.categories = frozenset(categories) | frozenset(self.columns['category'])
+        self.loaded_at = loaded_at
+
+        by_category = {}
+        for i, category in enumerate(self.columns['category']):
+            by_category.setdefault(category, []).append(i)
+
+        self.orders = {}
+        for sort, key in SORTS.items():
+            self.orders[None, sort] = sorted(range(len(rows)), key=lambda i: key(self.columns, i))
+            for category, indexes in by_category.items():
+                self.orders[category, sort] = sorted(indexes, key=lambda i: key(self.columns, i))
+
+    def rows(self, indexes, columns):
+        selected = [self.columns[column] for column in columns]
+        return [tuple(values[i] for values in selected) for i in indexes]
+
+    def page(self, category, sort, offset, limit):
+        return self.orders.get((category, sort), [])[offset:offset + limit]
+
+    def get(self, item_id):
+        return self.position.get(item_id)
+
+    def with_changes(self, changed_rows, deleted_ids, loaded_at):
+        rows = {item_id: tuple(self.columns[column][i] for column in COLUMNS) for item_id, i in self.position.items()}
+        for item_id in deleted_ids:
+            rows.pop(item_id, None)
+        for row in changed_rows:
+            rows[row[0]] = row
+        return CatalogSnapshot(rows.values(), self.categories, loaded_at)
+
+
+class CatalogReplica:
+    """In-process, read-only replica of the item catalog.
+
+    Loaded in full at start, then kept up to date from the item_changes notifications (see
+    migrate.py): changed ids are coalesced for `coalesce` seconds and re-read in one query.
+
+    Every `max_staleness` / 2 seconds the replica sends a token on catalog_sync and checks that the
+    item trigger exists. Notifications arrive in commit order, so once its own token comes back and
+    everything queued before it is applied, the snapshot is known to hold every change committed
+    before the token was sent. `synced_at` is that send time; the snapshot is only served while it
+    is at most `max_staleness` seconds old, otherwise callers go to the database. A failing
+    refresh, a listener that is down or a missing trigger all stop `synced_at` from advancing. A
+    full reload every `full_reload` seconds repairs anything that was missed.
+    """
+
+    def __init__(self, connect, listener, max_staleness=5.0, full_reload=300.0, coalesce=0.05):
+        self.max_staleness = max_staleness
+        self.full_reload = full_reload
+        self.coalesce = coalesce
+        self.snapshot = None
+        self.synced_at = None  # monotonic time the snapshot is known to be current as of
+        self._connect = connect
+        self._conn = None
+        self._pending = set()
+        self._reload = False
+        self._tokens = {}  # catalog_sync token: monotonic time it was sent
+        self._returned = None  # send time of the latest token that came back
+        self._sync_sent = 0
+        self._trigger_missing = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        listener.subscribe('item_changes', self._on_change, on_reconnect=self.request_reload)
+        listener.subscribe('catalog_sync', self._on_sync)
+
+    def start(self):
+        self.request_reload()
+        threading.Thread(target=self._run, name='catalog-replica', daemon=True).start()
+
+    def fresh_snapshot(self):
+        """The snapshot when it is within the staleness bound, None when the database must be used."""
+        snapshot, synced_at = self.snapshot, self.synced_at
+        if snapshot is None or synced_at is None or time.monotonic() - synced_at > self.max_staleness:
+            return None
+        return snapshot
+
+    def request_reload(self):
+        with self._lock:
+            self._reload = True
+        self._wakeup.set()
+
+    def _on_change(self, payload):
+        item_id = json.loads(payload)['item_id']
+        with self._lock:
+            self._pending.add(item_id)
+        self._wakeup.set()
+
+    def _on_sync(self, payload):
+        with self._lock:
+            sent_at = self._tokens.pop(payload, None)  # other processes' tokens are ignored
+            if sent_at is not None:
+                self._returned = sent_at
+        self._wakeup.set()
+
+    def _run(self):
+        heartbeat = self.max_staleness / 2
+        while True:
+            self._wakeup.wait(timeout=heartbeat)
+            time.sleep(self.coalesce)  # let a burst of changes pile up
+            self._wakeup.clear()
+
+            with self._lock:
+                # the changes notified before the returned token are all in `pending`
+                pending, self._pending = self._pending, set()
+                reload, self._reload = self._reload, False
+                returned, self._returned = self._returned, None
+
+            try:
+                if reload or self.snapshot is None or time.monotonic() - self.snapshot.loaded_at >= self.full_reload:
+                    self._load()
+                elif pending:
+                    self._apply(pending)
+                if returned is not None and self.snapshot is not None:
+                    self.synced_at = max(self.synced_at or 0, returned)
+                if time.monotonic() - self._sync_sent >= heartbeat:
+                    self._send_sync()
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'Catalog replica refresh - error: {error}')
+                self._close()
+                self.request_reload()
+                time.sleep(1)
+
+    def _cursor(self):
+        if self._conn is None or self._conn.closed:
+            self._conn = self._connect()
+            self._conn.autocommit = True
+        return self._conn.cursor()
+
+    def _close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except psycopg2.Error:
+                pass
+            self._conn = None
+
+    def _trigger_installed(self, cur):
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'item_changes' AND tgrelid = 'item'::regclass)")
+        installed = cur.fetchone()[0]
+        if not installed and self._trigger_missing is not True:
+            logger.error('Catalog replica: the item_changes trigger is missing (run python migrate.py), '
+                         'serving items from the database')
+        self._trigger_missing = not installed
+        return installed
+
+    def _send_sync(self):
+        now = time.monotonic()
+        self._sync_sent = now
+        cur = self._cursor()
+        if not self._trigger_installed(cur):
+            return
+        token = str(uuid.uuid4())
+        with self._lock:
+            # tokens lost with a listener reconnection never come back
+            self._tokens = {t: sent_at for t, sent_at in self._tokens.items() if now - sent_at < 60}
+            self._tokens[token] = now
+        cur.execute("SELECT pg_notify('catalog_sync', %s)", (token,))
+
+    def _load(self):
+        started = time.monotonic()
+        cur = self._cursor()
+        installed = self._trigger_installed(cur)
+        cur.execute(f"SELECT {ITEM_SCHEMA.select_list()} FROM item")
+        rows = cur.fetchall()
+        cur.execute("SELECT name FROM category")
+        categories = [row[0] for row in cur.fetchall()]
+        self.snapshot = CatalogSnapshot(rows, categories, started)
+        if installed:
+            # it holds everything committed before the query
+            self.synced_at = max(self.synced_at or 0, started)
+
+    def _apply(self, item_ids):
+        cur = self._cursor()
+        cur.execute(f"SELECT {ITEM_SCHEMA.select_list()} FROM item WHERE item_id = ANY(%s)", (list(item_ids),))
+        rows = cur.fetchall()
+
+        found = {row[0] for row in rows}
+        snapshot = self.snapshot
+        self.snapshot = snapshot.with_changes(rows, item_ids - found, snapshot.loaded_at)
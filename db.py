@@ -0,0 +1,51 @@
+import os
+import functools
+
+
+@functools.lru_cache(maxsize=None)
+def env_file():
+    # read once, the first time a setting is asked for
+    from dotenv import dotenv_values
+    return dotenv_values(os.environ.get('ENV_FILE', '.env'))
+
+
+def setting(name, default=None, cast=str):
+    """A setting from the environment, then from the .env file, then `default`."""
+    value = os.environ.get(name)
+    if value is None:
+        value = env_file().get(name)
+    if value is None:
+        return default
+    return cast(value)
+
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))  # respects container/cgroup cpu pinning
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def web_concurrency():
+    """Worker processes gunicorn runs, see gunicorn.conf.py."""
+    return setting('WEB_CONCURRENCY', available_cpus() * 2 + 1, int)
+
+
+def api_threads():
+    """Threads per worker, the most requests one worker handles at once."""
+    return setting('API_THREADS', 4, int)
+
+
+def db_connection(**kwargs):
+    import psycopg2
+
+    db = psycopg2.connect(
+        user=setting('DB_USER', 'postgres'),
+        password=setting('DB_PASSWORD', 'postgres'),
+        host=setting('DB_HOST', 'localhost'),
+        port=setting('DB_PORT', '5432'),
+        database=setting('DB_NAME', 'pet_store_db'),
+        **kwargs
+    )
+
+    return db
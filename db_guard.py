@@ -0,0 +1,207 @@
+import time
+import threading
+import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+from collections import deque
+from db import db_connection, setting
+from slow_queries import slow_query_log
+import metrics
+
+# (statement_timeout, lock_timeout) in milliseconds per Flask endpoint, 0 means no limit
+DEFAULT_BUDGET = (setting('DB_STATEMENT_TIMEOUT_MS', 2000, int),
+                  setting('DB_LOCK_TIMEOUT_MS', 1000, int))
+ROUTE_BUDGETS = {
+    'get_top_sales_per_category': (setting('DB_STATS_TIMEOUT_MS', 10000, int), DEFAULT_BUDGET[1]),
+    'get_clients_with_filters': (setting('DB_STATS_TIMEOUT_MS', 10000, int), DEFAULT_BUDGET[1]),
+    'purchase_items': (setting('DB_CHECKOUT_TIMEOUT_MS', 5000, int), DEFAULT_BUDGET[1]),
+    'bulk_update_items': (setting('DB_BULK_TIMEOUT_MS', 120000, int), DEFAULT_BUDGET[1]),
+}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Stops sending work to the database while it is failing.
+
+    closed: everything goes through, the last `window` outcomes are tracked. Once at least
+    `min_calls` are known and the failure rate reaches `failure_rate` it trips to open.
+    open: calls fail at once with CircuitOpenError for `reset_timeout` seconds.
+    half_open: one probe call is let through, the outcome of its first statement closes or
+    reopens the circuit (a connection alone proves nothing: a slow query or a locked row still
+    accepts them). A probe that hasn't decided anything `reset_timeout` seconds after it was
+    handed out (its connection leaked without running a statement) is given to the next call.
+    """
+
+    def __init__(self, window=50, min_calls=20, failure_rate=0.5, reset_timeout=10):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self._outcomes = deque(maxlen=window)  # 1 for a failure, 0 for a success
+        self._opened_at = 0
+        self._probing = False
+        self._probe_at = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CircuitOpenError unless the call may go through. Returns True when it is the half-open probe."""
+        with self._lock:
+            if self.state == 'open':
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    metrics.incr('db.circuit_rejected')
+                    raise CircuitOpenError('The database is unavailable, try again shortly.')
+                self.state = 'half_open'
+
+            if self.state == 'half_open':
+                if self._probing and time.monotonic() - self._probe_at < self.reset_timeout:
+                    metrics.incr('db.circuit_rejected')
+                    raise CircuitOpenError('The database is unavailable, try again shortly.')
+                if self._probing:
+                    metrics.incr('db.probes_reclaimed')
+                self._probing = True
+                self._probe_at = time.monotonic()
+                return True
+        return False
+
+    def abandon_probe(self):
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False  # the probe ran no statement, the next call probes instead
+
+    def record_success(self):
+        with self._lock:
+            if self.state == 'half_open':
+                self.state = 'closed'
+                self._probing = False
+                self._outcomes.clear()
+            self._outcomes.append(0)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == 'half_open':
+                self._trip()
+                return
+
+            self._outcomes.append(1)
+            if (self.state == 'closed' and len(self._outcomes) >= self.min_calls and
+                    sum(self._outcomes) / len(self._outcomes) >= self.failure_rate):
+                self._trip()
+
+    def retry_after(self):
+        return max(0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def _trip(self):
+        # must be called with the lock held
+        self.state = 'open'
+        self._opened_at = time.monotonic()
+        self._probing = False
+        self._outcomes.clear()
+        metrics.incr('db.circuit_trips')
+
+
+breaker = CircuitBreaker(window=setting('BREAKER_WINDOW', 50, int),
+                         min_calls=setting('BREAKER_MIN_CALLS', 20, int),
+                         failure_rate=setting('BREAKER_FAILURE_RATE', 0.5, float),
+                         reset_timeout=setting('BREAKER_RESET_TIMEOUT', 10, float))
+
+
+class GuardedConnection(psycopg2.extensions.connection):
+    probe = False  # set while this is the half-open probe and its first statement hasn't run
+
+    def close(self):
+        if self.probe:
+            self.probe = False
+            breaker.abandon_probe()
+        super().close()
+
+
+class CopySource:
+    """The file COPY reads from, noting whether reading it failed."""
+
+    def __init__(self, file):
+        self.file = file
+        self.failed = False
+
+    def read(self, size=-1):
+        try:
+            return self.file.read(size)
+        except Exception:
+            self.failed = True
+            raise
+
+    def readline(self, size=-1):
+        try:
+            return self.file.readline(size)
+        except Exception:
+            self.failed = True
+            raise
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)  # write() for COPY ... TO STDOUT
+
+
+class GuardedCursor(psycopg2.extensions.cursor):
+    """Cursor that reports every statement's outcome to the circuit breaker and the metrics,
+    and its duration to the slow query log. COPY (copy_expert) goes through the same path."""
+
+    def execute(self, query, vars=None):
+        return self._guarded(query, vars, None, super().execute, query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        source = CopySource(file)
+        return self._guarded(sql, None, source, super().copy_expert, sql, source, size)
+
+    def _guarded(self, query, vars, source, call, *args):
+        self.connection.probe = False  # this statement's outcome decides the probe
+        start = time.perf_counter()
+        try:
+            result = call(*args)
+        except psycopg2.Error as error:
+            if source is not None and source.failed:
+                # COPY's input couldn't be read (a bad feed line...), psycopg2 reports it as QueryCanceled
+                breaker.record_success()
+                outcome = 'copy_input'
+            elif isinstance(error, psycopg2.errors.QueryCanceled):
+                metrics.incr('db.statement_timeouts')
+                breaker.record_failure()
+                outcome = 'statement_timeout'
+            elif isinstance(error, psycopg2.errors.LockNotAvailable):
+                metrics.incr('db.lock_timeouts')
+                breaker.record_failure()
+                outcome = 'lock_timeout'
+            elif isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+                metrics.incr('db.errors')
+                breaker.record_failure()
+                outcome = type(error).__name__
+            else:
+                # anything else (constraint violations, bad input...) is the request's fault, not the database's
+                breaker.record_success()
+                outcome = type(error).__name__
+            self._record(query, vars, start, outcome)
+            raise
+        breaker.record_success()
+        self._record(query, vars, start)
+        return result
+
+    def _record(self, query, vars, start, error=None):
+        slow_query_log.record(self, query, vars, (time.perf_counter() - start) * 1000, error)
+
+
+def guarded_connection(endpoint):
+    """Opens a connection with the endpoint's latency budget, unless the circuit is open."""
+    probe = breaker.before_call()
+
+    statement_timeout, lock_timeout = ROUTE_BUDGETS.get(endpoint, DEFAULT_BUDGET)
+    try:
+        conn = db_connection(options=f'-c statement_timeout={statement_timeout} -c lock_timeout={lock_timeout}',
+                             connection_factory=GuardedConnection, cursor_factory=GuardedCursor)
+    except psycopg2.OperationalError:
+        metrics.incr('db.connect_errors')
+        breaker.record_failure()
+        raise
+
+    conn.probe = probe
+    return conn
@@ -0,0 +1,273 @@
+import os
+import json
+import fcntl
+import shutil
+import string
+import logging
+import argparse
+import datetime
+import psycopg2
+import pandas as pd
+from db import db_connection, setting
+
+EXPORT_DIR = setting('EXPORT_DIR', 'exports')
+EXPORT_CHUNK_ROWS = setting('EXPORT_CHUNK_ROWS', 100000, int)
+# orders are only exported once they are older than this lag, so transactions that
+# started before the export (and still hold an older NOW()) are not skipped
+EXPORT_WATERMARK_LAG = setting('EXPORT_WATERMARK_LAG', 300, int)
+
+# name: (select statement, watermark column or None for a full snapshot)
+EXPORTS = {
+    'item': ("""SELECT item_id, name, category, price, stock, description, manufacturer, weight,
+                       image_url, total_unit_sales
+                FROM item""", None),
+    'client': ("""SELECT client_id, name, email, last_purch_date, last_item_bought
+                  FROM client""", None),
+    'purchase': ("""SELECT order_id, total_price, order_date, client_client_id
+                    FROM purchase""", 'purchase.order_date'),
+    'purchaseitem': ("""SELECT purchaseitem.purchase_order_id, purchaseitem.item_item_id, purchaseitem.quantity,
+                               purchase.order_date
+                        FROM purchaseitem
+                        JOIN purchase ON purchaseitem.purchase_order_id = purchase.order_id""", 'purchase.order_date'),
+    # joined view: one row per order line with the order and item attributes
+    'orders': ("""SELECT purchase.order_id, purchase.order_date, purchase.client_client_id, purchase.total_price,
+                         purchaseitem.item_item_id, item.name AS item_name, item.category, item.price,
+                         purchaseitem.quantity
+                  FROM purchase
+                  JOIN purchaseitem ON purchase.order_id = purchaseitem.purchase_order_id
+                  JOIN item ON purchaseitem.item_item_id = item.item_id""", 'purchase.order_date'),
+}
+
+FORMATS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+
+logger = logging.getLogger('logger')
+
+
+class ExportInProgress(Exception):
+    pass
+
+
+def validate(tables, fmt):
+    """The tables to export (all of them when `tables` is empty), ValueError for an unknown table or format."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}'. Use one of: {', '.join(FORMATS)}")
+
+    tables = tables or list(EXPORTS)
+    unknown = [name for name in tables if name not in EXPORTS]
+    if unknown:
+        raise ValueError(f"Unknown export tables: {', '.join(unknown)}")
+    return tables
+
+
+def acquire_lock(out_dir):
+    """An open lock file held until closed: one export at a time per directory, whichever process runs it."""
+    os.makedirs(out_dir, exist_ok=True)
+    lock = open(os.path.join(out_dir, '.export.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        raise ExportInProgress('Another export is running, try again when it is done.')
+    return lock
+
+
+def load_watermarks(out_dir):
+    path = os.path.join(out_dir, 'watermarks.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_watermarks(out_dir, watermarks):
+    path = os.path.join(out_dir, 'watermarks.json')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(tmp_path, path)  # atomic, a crash never leaves a half written file
+
+
+def write_chunk(df, path, fmt):
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.reset_index(drop=True).to_feather(path)
+
+
+def export_table(conn, name, table_dir, run_id, fmt='parquet', chunk_rows=EXPORT_CHUNK_ROWS, since=None, until=None):
+    """Streams one export through a server-side cursor, writing one file per chunk into `table_dir`.
+
+    Only `chunk_rows` rows are held in memory at a time. Returns the list of files written.
+    """
+    statement, watermark_column = EXPORTS[name]
+    values = []
+
+    if watermark_column is not None:
+        conditions = []
+        if since is not None:
+            conditions.append(f'{watermark_column} > %s')
+            values.append(since)
+        if until is not None:
+            conditions.append(f'{watermark_column} <= %s')
+            values.append(until)
+        if conditions:
+            statement += ' WHERE ' + ' AND '.join(conditions)
+        statement += f' ORDER BY {watermark_column}'
+
+    os.makedirs(table_dir, exist_ok=True)
+
+    files = []
+    # a named cursor keeps the result set on the server, rows are pulled chunk by chunk
+    cur = conn.cursor(name=f'export_{name}')
+    cur.itersize = chunk_rows
+    try:
+        cur.execute(statement, values)
+        columns = None
+        part = 0
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                break
+            if columns is None:
+                columns = [column[0] for column in cur.description]
+
+            path = os.path.join(table_dir, f'part-{run_id}-{part:05d}{FORMATS[fmt]}')
+            write_chunk(pd.DataFrame.from_records(rows, columns=columns), path, fmt)
+            files.append(path)
+            part += 1
+    finally:
+        cur.close()
+
+    return files
+
+
+def publish(staging_dir, table_dir, replace):
+    """Moves the files of a finished run from `staging_dir` into `table_dir`, so <out_dir>/<table>
+    only ever holds complete runs. With `replace` they take the place of the files already there
+    (a snapshot, or a full export), otherwise they are added to them.
+
+    Returns the published files.
+    """
+    os.makedirs(staging_dir, exist_ok=True)  # a run without rows wrote nothing
+    names = sorted(os.listdir(staging_dir))
+    if replace:
+        old_dir = staging_dir + '.old'
+        if os.path.exists(table_dir):
+            os.rename(table_dir, old_dir)
+        os.rename(staging_dir, table_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+    else:
+        os.makedirs(table_dir, exist_ok=True)
+        for file_name in names:
+            os.replace(os.path.join(staging_dir, file_name), os.path.join(table_dir, file_name))
+        os.rmdir(staging_dir)
+    return [os.path.join(table_dir, file_name) for file_name in names]
+
+
+def export_data(tables=None, out_dir=EXPORT_DIR, fmt='parquet', chunk_rows=EXPORT_CHUNK_ROWS, incremental=True,
+                lock=None, run_id=None):
+    """Exports `tables`; a full (not incremental) export starts them from scratch.
+
+    Every run writes into <out_dir>/.staging/<run_id> first, see publish(). Holds the export lock
+    of `out_dir` while it runs, `lock` is one already taken by the caller.
+    """
+    tables = validate(tables, fmt)
+    lock = lock or acquire_lock(out_dir)
+    run_id = run_id or datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')
+
+    # with the lock held, whatever is in .staging was left by a run that crashed
+    staging_root = os.path.join(out_dir, '.staging')
+    shutil.rmtree(staging_root, ignore_errors=True)
+
+    # the watermarks of the tables not exported this time are kept as they are
+    watermarks = load_watermarks(out_dir)
+
+    conn = db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT LOCALTIMESTAMP - make_interval(secs => %s)", (EXPORT_WATERMARK_LAG,))
+        until = cur.fetchone()[0]
+        cur.close()
+
+        summary = {}
+        for name in tables:
+            watermark_column = EXPORTS[name][1]
+            since = watermarks.get(name) if watermark_column is not None and incremental else None
+
+            staging_dir = os.path.join(staging_root, run_id, name)
+            export_table(conn, name, staging_dir, run_id, fmt, chunk_rows, since=since, until=until)
+            # without a `since` the run holds every row of the table, it replaces what was exported before
+            files = publish(staging_dir, os.path.join(out_dir, name), replace=since is None)
+            summary[name] = {'files': files, 'since': since}
+
+            if watermark_column is not None:
+                # saved as soon as the files are published, a later table failing doesn't re-export these rows
+                watermarks[name] = until.isoformat()
+                save_watermarks(out_dir, watermarks)
+                summary[name]['until'] = watermarks[name]
+
+        conn.commit()
+    finally:
+        conn.close()
+        shutil.rmtree(staging_root, ignore_errors=True)
+        lock.close()
+
+    return summary
+
+
+def job_path(out_dir, job_id):
+    return os.path.join(out_dir, 'jobs', f'{job_id}.json')
+
+
+def save_job(out_dir, job):
+    path = job_path(out_dir, job['job_id'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(job, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_job(out_dir, job_id):
+    """The status of an export job, None when there is no such job."""
+    if not job_id or not set(job_id) <= set(string.hexdigits):
+        return None
+    try:
+        with open(job_path(out_dir, job_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def run_job(job_id, tables, out_dir, fmt, incremental, lock):
+    """Runs an export in the background, its status is kept in <out_dir>/jobs/<job_id>.json."""
+    job = {'job_id': job_id, 'status': 'running', 'tables': tables, 'format': fmt,
+           'started_at': datetime.datetime.now().isoformat()}
+    save_job(out_dir, job)
+    try:
+        job['result'] = export_data(tables, out_dir, fmt, incremental=incremental, lock=lock, run_id=job_id)
+        job['status'] = 'done'
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f'Export {job_id} - error: {error}')
+        job['status'] = 'failed'
+        job['error'] = str(error)
+    finally:
+        lock.close()
+    job['finished_at'] = datetime.datetime.now().isoformat()
+    save_job(out_dir, job)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the pet store tables to columnar files.')
+    parser.add_argument('tables', nargs='*', help=f"tables to export (default: all of {', '.join(EXPORTS)})")
+    parser.add_argument('--out', default=EXPORT_DIR, help='output directory')
+    parser.add_argument('--format', default='parquet', choices=list(FORMATS))
+    parser.add_argument('--chunk-rows', type=int, default=EXPORT_CHUNK_ROWS)
+    parser.add_argument('--full', action='store_true', help='ignore the stored watermarks and export everything')
+    args = parser.parse_args()
+
+    result = export_data(args.tables, args.out, args.format, args.chunk_rows, incremental=not args.full)
+    for table, info in result.items():
+        print(f"{table}: {len(info['files'])} file(s)")
@@ -0,0 +1,29 @@
+# Production server: gunicorn -c gunicorn.conf.py api:app
+# Graceful reload (new code/config, in-flight requests finish): kill -HUP <master pid>
+from db import setting, web_concurrency, api_threads
+
+bind = f"{setting('API_HOST', '0.0.0.0')}:{setting('API_PORT', 8080)}"
+
+# one process per core works around the GIL; threads overlap the time spent waiting on Postgres
+workers = web_concurrency()
+worker_class = 'gthread'
+threads = api_threads()
+
+keepalive = setting('API_KEEPALIVE', 5, int)
+timeout = setting('API_TIMEOUT', 30, int)
+graceful_timeout = setting('API_GRACEFUL_TIMEOUT', 30, int)
+
+# recycle workers now and then so a leak in one of them can't grow forever
+max_requests = setting('API_MAX_REQUESTS', 10000, int)
+max_requests_jitter = setting('API_MAX_REQUESTS_JITTER', 1000, int)
+
+# the app is imported in each worker, so no connection or cache is created before the fork
+preload_app = False
+
+accesslog = setting('API_ACCESS_LOG', '-')
+errorlog = setting('API_ERROR_LOG', '-')
+
+
+def post_worker_init(worker):
+    from api import init_worker
+    init_worker()
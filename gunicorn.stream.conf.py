@@ -0,0 +1,45 @@
+# Item change stream server: gunicorn -c gunicorn.stream.conf.py stream_app:app
+# gevent workers: each open stream is a greenlet, thousands of them fit in one process
+from db import setting
+
+bind = f"{setting('STREAM_HOST', '0.0.0.0')}:{setting('STREAM_PORT', 8081)}"
+
+# the fan-out is cheap, a few processes are enough; each one holds a single LISTEN connection
+workers = setting('STREAM_WORKERS', 2, int)
+worker_class = 'gevent'
+# open streams per worker, a bit over STREAM_MAX_SUBSCRIBERS so the 503 answers still get through
+worker_connections = setting('STREAM_MAX_SUBSCRIBERS', 5000, int) + 100
+
+timeout = setting('API_TIMEOUT', 30, int)
+graceful_timeout = setting('API_GRACEFUL_TIMEOUT', 30, int)
+
+preload_app = False
+
+accesslog = setting('API_ACCESS_LOG', '-')
+errorlog = setting('API_ERROR_LOG', '-')
+
+
+def gevent_wait_callback(conn, timeout=None):
+    # psycopg2 blocks in C while it waits on the server, this yields to the other greenlets instead
+    import psycopg2
+    from psycopg2 import extensions
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f'Bad result from poll: {state!r}')
+
+
+def post_worker_init(worker):
+    from psycopg2 import extensions
+    extensions.set_wait_callback(gevent_wait_callback)
+
+    from stream_app import init_worker
+    init_worker()
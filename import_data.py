@@ -0,0 +1,178 @@
+import io
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from db import db_connection, setting
+
+# table: (primary key, columns, serial column or None)
+TABLES = {
+    'category': (['name'], ['name'], None),
+    'client': (['client_id'], ['client_id', 'name', 'email', 'last_purch_date', 'last_item_bought'], None),
+    'item': (['item_id'], ['item_id', 'name', 'category', 'price', 'stock', 'description', 'manufacturer',
+                           'weight', 'image_url', 'total_unit_sales'], 'item_id'),
+    'shoppingcart': (['client_client_id'], ['data', 'tempo', 'client_client_id'], None),
+    'purchase': (['order_id'], ['order_id', 'total_price', 'order_date', 'client_client_id'], 'order_id'),
+    'cartitem': (['shoppingcart_client_client_id', 'item_item_id'],
+                 ['quantity', 'item_item_id', 'shoppingcart_client_client_id'], None),
+    'purchaseitem': (['purchase_order_id', 'item_item_id'], ['quantity', 'purchase_order_id', 'item_item_id'], None),
+}
+
+# foreign keys only point to tables of an earlier level, the tables of one level load in parallel
+LEVELS = [
+    ['category', 'client'],
+    ['item', 'shoppingcart', 'purchase'],
+    ['cartitem', 'purchaseitem'],
+]
+
+IMPORT_CHUNK_ROWS = setting('IMPORT_CHUNK_ROWS', 50000, int)
+
+
+def checkpoint_path(directory, table):
+    return os.path.join(directory, '.checkpoints', f'{table}.json')
+
+
+def read_checkpoint(directory, table, path):
+    """(rows, byte offset) of `path` already committed, None when there is no checkpoint or the file changed since."""
+    try:
+        with open(checkpoint_path(directory, table)) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    stat = os.stat(path)
+    if checkpoint['size'] != stat.st_size or checkpoint['mtime'] != stat.st_mtime or 'offset' not in checkpoint:
+        return None
+    return checkpoint['rows'], checkpoint['offset']
+
+
+def write_checkpoint(directory, table, path, rows, offset, done=False):
+    stat = os.stat(path)
+    target = checkpoint_path(directory, table)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target + '.tmp', 'w') as f:
+        json.dump({'rows': rows, 'offset': offset, 'done': done, 'size': stat.st_size, 'mtime': stat.st_mtime}, f)
+    os.replace(target + '.tmp', target)
+
+
+def read_chunks(f, chunk_rows):
+    """Yields (csv bytes, records, end offset) for every `chunk_rows` CSV records of the binary file `f`.
+
+    A record ends at a newline outside quotes: a quoted field may hold newlines, and escaped
+    quotes ("") don't change the count's parity.
+    """
+    lines, records, quotes = [], 0, 0
+    for line in iter(f.readline, b''):
+        lines.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2:
+            continue  # the newline is inside a quoted field
+        quotes = 0
+        records += 1
+        if records == chunk_rows:
+            yield b''.join(lines), records, f.tell()
+            lines, records = [], 0
+    if lines:
+        yield b''.join(lines), records, f.tell()
+
+
+def upsert_statement(table, columns):
+    primary_key, _, _ = TABLES[table]
+    updates = [column for column in columns if column not in primary_key]
+    conflict = (f"DO UPDATE SET {', '.join(f'{column} = EXCLUDED.{column}' for column in updates)}"
+                if updates else "DO NOTHING")
+    # a key repeated inside one chunk would make ON CONFLICT touch a row twice, the last one wins
+    return f"""INSERT INTO {table} ({', '.join(columns)})
+               SELECT DISTINCT ON ({', '.join(primary_key)}) {', '.join(columns)}
+               FROM import_staging
+               ORDER BY {', '.join(primary_key)}, ctid DESC
+               ON CONFLICT ({', '.join(primary_key)}) {conflict}"""
+
+
+def load_table(table, directory, chunk_rows=IMPORT_CHUNK_ROWS):
+    """Upserts `<directory>/<table>.csv` chunk by chunk, one transaction and checkpoint per chunk.
+
+    Returns the number of rows loaded by this run.
+    """
+    path = os.path.join(directory, f'{table}.csv')
+    primary_key, table_columns, serial_column = TABLES[table]
+
+    with open(path, 'rb') as f:
+        columns = [column.strip() for column in f.readline().decode().split(',')]
+        header_end = f.tell()
+    unknown = [column for column in columns if column not in table_columns]
+    if unknown or not set(primary_key) <= set(columns):
+        raise ValueError(f"{path}: the header must have {', '.join(primary_key)} and only columns of "
+                         f"{table}; unknown: {', '.join(unknown) or '-'}")
+
+    # resuming seeks past what was committed, nothing before it is read again
+    done, offset = read_checkpoint(directory, table, path) or (0, header_end)
+    loaded = 0
+
+    conn = db_connection()
+    f = open(path, 'rb')
+    try:
+        cur = conn.cursor()
+        cur.execute(f"CREATE TEMP TABLE import_staging AS SELECT {', '.join(columns)} FROM {table} WITH NO DATA")
+        conn.commit()
+        statement = upsert_statement(table, columns)
+
+        # the records are handed to COPY as they are in the file, Postgres does the parsing
+        f.seek(offset)
+        for chunk, records, offset in read_chunks(f, chunk_rows):
+            cur.copy_expert(f"COPY import_staging ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+                            io.BytesIO(chunk))
+            cur.execute(statement)
+            cur.execute("TRUNCATE import_staging")
+            conn.commit()
+
+            # after the commit: a crash in between replays this chunk, which the upsert makes harmless
+            done += records
+            loaded += records
+            write_checkpoint(directory, table, path, done, offset)
+
+        if serial_column is not None:
+            # explicit ids were inserted, move the sequence past them so new rows don't collide
+            cur.execute(f"""SELECT setval(pg_get_serial_sequence('{table}', '{serial_column}'),
+                                          COALESCE((SELECT MAX({serial_column}) FROM {table}), 1))""")
+            conn.commit()
+
+        write_checkpoint(directory, table, path, done, offset, done=True)
+    finally:
+        f.close()
+        conn.close()
+
+    return loaded
+
+
+def import_data(directory, workers=None, chunk_rows=IMPORT_CHUNK_ROWS, restart=False):
+    if restart:
+        for table in TABLES:
+            try:
+                os.remove(checkpoint_path(directory, table))
+            except FileNotFoundError:
+                pass
+
+    summary = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for level in LEVELS:
+            tables = [table for table in level if os.path.exists(os.path.join(directory, f'{table}.csv'))]
+            futures = {table: executor.submit(load_table, table, directory, chunk_rows) for table in tables}
+            # the next level references these tables, wait until all of them are in
+            for table, future in futures.items():
+                summary[table] = future.result()
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import <table>.csv files into the pet store database. '
+                                                 'Rows are upserted; an interrupted import resumes where it stopped.')
+    parser.add_argument('directory', help='directory with the CSV files, e.g. item.csv, client.csv')
+    parser.add_argument('--workers', type=int, help='parallel worker processes (default: number of cores)')
+    parser.add_argument('--chunk-rows', type=int, default=IMPORT_CHUNK_ROWS)
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoints and import everything again')
+    args = parser.parse_args()
+
+    result = import_data(args.directory, args.workers, args.chunk_rows, args.restart)
+    for table, rows in result.items():
+        print(f'{table}: {rows} rows')
@@ -0,0 +1,174 @@
+import json
+import time
+import threading
+from collections import defaultdict
+import metrics
+
+ALL_ITEMS = None
+
+
+class Subscription:
+    """One open stream. Changes wait in `pending` keyed by item, so a burst of changes to the same
+    item collapses into its latest state; more than `max_pending` distinct items waiting means the
+    consumer can't keep up and it is dropped.
+    """
+    __slots__ = ('item_ids', 'max_pending', 'pending', 'dropped', 'resync', 'closed', '_ready')
+
+    def __init__(self, item_ids, max_pending):
+        self.item_ids = item_ids  # frozenset of item ids, or ALL_ITEMS
+        self.max_pending = max_pending
+        self.pending = {}
+        self.dropped = False
+        self.resync = False
+        self.closed = False
+        self._ready = threading.Condition(threading.Lock())
+
+    def offer(self, change):
+        with self._ready:
+            if self.dropped:
+                return
+            self.pending[change['item_id']] = change
+            if len(self.pending) > self.max_pending:
+                self.dropped = True
+                self.pending = {}
+            self._ready.notify()
+
+    def request_resync(self):
+        with self._ready:
+            self.resync = True
+            self._ready.notify()
+
+    def wait(self, timeout):
+        """Blocks until something is pending or `timeout` expires.
+
+        Returns (changes, resync, dropped) and empties the buffer.
+        """
+        with self._ready:
+            if not (self.pending or self.resync or self.dropped):
+                self._ready.wait(timeout)
+            changes, self.pending = list(self.pending.values()), {}
+            resync, self.resync = self.resync, False
+            return changes, resync, self.dropped
+
+
+class ChangeBroadcaster:
+    """Fans the item_changes notifications of the process' listener out to the open streams.
+
+    Only changes to price or stock are forwarded; the callback runs on the listener thread and
+    only hands each change to the subscriptions interested in that item.
+    """
+
+    def __init__(self, listener, max_subscribers=100, max_pending=1000):
+        self.max_subscribers = max_subscribers
+        self.max_pending = max_pending
+        self._all = set()
+        self._by_item = defaultdict(set)
+        self._last = {}  # item_id: (price, stock) last forwarded
+        self._subscribers = 0
+        self._lock = threading.Lock()
+        listener.subscribe('item_changes', self._on_change, on_reconnect=self._on_reconnect)
+
+    def count(self):
+        return self._subscribers
+
+    def subscribe(self, item_ids=ALL_ITEMS):
+        """A new Subscription, None when this process already serves `max_subscribers` streams."""
+        subscription = Subscription(item_ids, self.max_pending)
+        with self._lock:
+            if self._subscribers >= self.max_subscribers:
+                return None
+            if item_ids is ALL_ITEMS:
+                self._all.add(subscription)
+            else:
+                for item_id in item_ids:
+                    self._by_item[item_id].add(subscription)
+            self._subscribers += 1
+        metrics.incr('stream.opened')
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription.closed:
+                return  # called both when the stream ends and when the response is closed
+            subscription.closed = True
+            if subscription.item_ids is ALL_ITEMS:
+                self._all.discard(subscription)
+            else:
+                for item_id in subscription.item_ids:
+                    subscribers = self._by_item.get(item_id)
+                    if subscribers is not None:
+                        subscribers.discard(subscription)
+                        if not subscribers:
+                            del self._by_item[item_id]
+            self._subscribers -= 1
+        if subscription.dropped:
+            metrics.incr('stream.dropped')
+
+    def _on_change(self, payload):
+        change = json.loads(payload)
+        item_id = change['item_id']
+
+        if change['op'] == 'DELETE':
+            self._last.pop(item_id, None)
+        else:
+            state = (change.get('price'), change.get('stock'))
+            if self._last.get(item_id) == state:
+                return  # some other column changed
+            self._last[item_id] = state
+
+        with self._lock:
+            targets = list(self._all)
+            targets.extend(self._by_item.get(item_id, ()))
+        for subscription in targets:
+            subscription.offer(change)
+
+    def _on_reconnect(self):
+        # notifications sent while the listener was down are lost, the clients have to re-read
+        self._last.clear()
+        with self._lock:
+            targets = list(self._all)
+            targets.extend({s for subscribers in self._by_item.values() for s in subscribers})
+        for subscription in targets:
+            subscription.request_resync()
+
+
+def sse(event, data=None, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, separators=(",", ":"))}')
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+def event_stream(broadcaster, subscription, heartbeat=15.0, coalesce=0.1, max_duration=3600.0):
+    """Server-Sent Events for `subscription`, until the client goes away or `max_duration` passes.
+
+    After each batch it waits `coalesce` seconds so a burst goes out as one write. A dropped
+    subscription gets an `overflow` event and the stream ends; EventSource reconnects by itself.
+    """
+    sequence = 0
+    deadline = time.monotonic() + max_duration
+    try:
+        yield b'retry: 2000\n\n'  # reconnection delay for EventSource, in milliseconds
+        while time.monotonic() < deadline:
+            changes, resync, dropped = subscription.wait(heartbeat)
+            if dropped:
+                yield sse('overflow', {'message': 'Too many changes pending, reconnect and re-read the items.'})
+                return
+            if resync:
+                yield sse('resync', {'message': 'Changes may have been missed, re-read the items.'})
+            if not changes and not resync:
+                yield b': heartbeat\n\n'  # also how a closed connection is noticed
+                continue
+
+            chunk = []
+            for change in changes:
+                sequence += 1
+                chunk.append(sse('item', change, sequence))
+            if chunk:
+                metrics.incr('stream.events', len(chunk))
+                yield b''.join(chunk)
+            time.sleep(coalesce)
+    finally:
+        broadcaster.unsubscribe(subscription)
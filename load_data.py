@@ -1,6 +1,6 @@
-import pandas as pd
 import psycopg2
-from dotenv import dotenv_values
+from db import db_connection
+from migrate import create_triggers
 
 def query(connection, statement, values=None):
     cur = connection.cursor()
@@ -15,21 +15,6 @@ def query(connection, statement, values=None):
         cur.close()
 
 
-def db_connection():
-
-    db = psycopg2.connect(
-        user='postgres',
-        password='postgres',
-        host='localhost',
-        port='5432',
-        database='pet_store_db'
-    )
-
-    return db
-
-
-conn = db_connection()
-
 drop_tables = """
     DROP TABLE IF EXISTS item CASCADE;
     DROP TABLE IF EXISTS client CASCADE;
@@ -40,7 +25,6 @@ drop_tables = """
     DROP TABLE IF EXISTS category CASCADE;
 """
 
-query(conn, drop_tables)
 
 create_tables = """
     CREATE TABLE category (
@@ -108,14 +92,9 @@ create_tables = """
     ALTER TABLE purchaseitem ADD CONSTRAINT purchaseitem_fk2 FOREIGN KEY (item_item_id) REFERENCES item(item_id);
 """
 
-query(conn, create_tables)
-
 
 # CATEGORIES table ---------------------------------------------------------------------------------------------------
 categories_data = ['Food', 'Toys', 'Accessories']
-for row in categories_data:
-    #print(f'Inserting category data: {row}')
-    query(conn, "INSERT INTO category (name) VALUES (%s)", (row,))
 
 
 # ITEM table ---------------------------------------------------------------------------------------------------
@@ -133,13 +112,6 @@ items_data = [
     (1821, 'Dei Acc', 'Accessories', 92.79, 150, 'Ouf Ouf Miau Miau', 'DEiPet', 0.7,'https://example.com/item-dei-toy.jpg', 8),
 ]
 
-for row in items_data:
-    #print(f'Inserting item data: {row}')
-    query(conn, '''
-        INSERT INTO item (item_id, name, category, price, stock, description, manufacturer, weight, image_url, total_unit_sales)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ''', row)
-
 
 # CLIENT table ---------------------------------------------------------------------------------------------------
 clients_data = [
@@ -153,13 +125,6 @@ clients_data = [
     ('client808', 'Angelina Jolie', 'angelinajolie@example.com', '2023-03-22', 'Durable Dog Chew Toy')
 ]
 
-for row in clients_data:
-    #print(f'Inserting client data: {row}')
-    query(conn, '''
-        INSERT INTO client (client_id, name, email, last_purch_date, last_item_bought)
-        VALUES (%s, %s, %s, %s, %s)
-    ''', row)
-
 
 # PURCHASE table ---------------------------------------------------------------------------------------------------
 purchase_data = [
@@ -172,12 +137,6 @@ purchase_data = [
     (1127, 12.27, '2023-10-12 20:23:00', 'client808'),
 ]
 
-for row in purchase_data:
-    #print(f'Inserting purchase data: {row}')
-    query(conn, '''
-        INSERT INTO purchase (order_id, total_price, order_date, client_client_id)
-        VALUES (%s, %s, %s, %s)
-    ''', row)
 
 # SHOPPINGCART table ---------------------------------------------------------------------------------------------------
 
@@ -191,12 +150,6 @@ shoppingcart_data = [
     ('2023-10-18', '2023-10-18 11:45:00', 'client505')
 ]
 
-for row in shoppingcart_data:
-    #print(f'Inserting shoppingcart data: {row}')
-    query(conn, '''
-        INSERT INTO shoppingcart (data, tempo, client_client_id)
-        VALUES (%s, %s, %s)
-    ''', row)
 
 # CARTITEM table ---------------------------------------------------------------------------------------------------
 
@@ -211,12 +164,6 @@ cartitem_data = [
     (3, 1246, 'client505')
 ]
 
-for row in cartitem_data:
-    #print(f'Inserting cartitem data: {row}')
-    query(conn, '''
-        INSERT INTO cartitem (quantity, item_item_id, shoppingcart_client_client_id)
-        VALUES (%s, %s, %s)
-    ''', row)
 
 # PURCHASEITEM table ---------------------------------------------------------------------------------------------------
 
@@ -231,11 +178,66 @@ purchaseitem_data = [
     (33, 1236, 1425),
 ]
 
-for row in purchaseitem_data:
-    #print(f'Inserting purchaseitem data: {row}')
-    query(conn, '''
-        INSERT INTO purchaseitem (quantity, purchase_order_id, item_item_id)
-        VALUES (%s, %s, %s)
-    ''', row)
 
-print("Done!")
\ No newline at end of file
+
+
+def main():
+    """Drops and recreates the schema, then seeds it with the sample data."""
+    conn = db_connection()
+    try:
+        query(conn, drop_tables)
+        query(conn, create_tables)
+        query(conn, create_triggers)
+        for row in categories_data:
+            #print(f'Inserting category data: {row}')
+            query(conn, "INSERT INTO category (name) VALUES (%s)", (row,))
+
+        for row in items_data:
+            #print(f'Inserting item data: {row}')
+            query(conn, '''
+                INSERT INTO item (item_id, name, category, price, stock, description, manufacturer, weight, image_url, total_unit_sales)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ''', row)
+
+        for row in clients_data:
+            #print(f'Inserting client data: {row}')
+            query(conn, '''
+                INSERT INTO client (client_id, name, email, last_purch_date, last_item_bought)
+                VALUES (%s, %s, %s, %s, %s)
+            ''', row)
+
+        for row in purchase_data:
+            #print(f'Inserting purchase data: {row}')
+            query(conn, '''
+                INSERT INTO purchase (order_id, total_price, order_date, client_client_id)
+                VALUES (%s, %s, %s, %s)
+            ''', row)
+
+        for row in shoppingcart_data:
+            #print(f'Inserting shoppingcart data: {row}')
+            query(conn, '''
+                INSERT INTO shoppingcart (data, tempo, client_client_id)
+                VALUES (%s, %s, %s)
+            ''', row)
+
+        for row in cartitem_data:
+            #print(f'Inserting cartitem data: {row}')
+            query(conn, '''
+                INSERT INTO cartitem (quantity, item_item_id, shoppingcart_client_client_id)
+                VALUES (%s, %s, %s)
+            ''', row)
+
+        for row in purchaseitem_data:
+            #print(f'Inserting purchaseitem data: {row}')
+            query(conn, '''
+                INSERT INTO purchaseitem (quantity, purchase_order_id, item_item_id)
+                VALUES (%s, %s, %s)
+            ''', row)
+    finally:
+        conn.close()
+
+    print("Done!")
+
+
+if __name__ == '__main__':
+    main()
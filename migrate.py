@@ -0,0 +1,58 @@
+from db import db_connection
+
+# every change to an item is published on the item_changes channel (catalog replica in api.py),
+# every change to a cart on cart_changes (cart cache in api.py)
+create_triggers = """
+    CREATE OR REPLACE FUNCTION notify_item_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('item_changes', json_build_object('op', TG_OP, 'item_id', OLD.item_id)::text);
+            RETURN OLD;
+        END IF;
+        PERFORM pg_notify('item_changes', json_build_object('op', TG_OP, 'item_id', NEW.item_id,
+                                                            'price', NEW.price, 'stock', NEW.stock,
+                                                            'price_changed', TG_OP = 'UPDATE' AND
+                                                                             NEW.price IS DISTINCT FROM OLD.price)::text);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS item_changes ON item;
+    CREATE TRIGGER item_changes AFTER INSERT OR UPDATE OR DELETE ON item
+        FOR EACH ROW EXECUTE FUNCTION notify_item_change();
+
+    -- TG_ARGV[0] is the table's client id column; repeated notifications in one transaction are sent once
+    CREATE OR REPLACE FUNCTION notify_cart_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' THEN
+            PERFORM pg_notify('cart_changes', to_jsonb(OLD) ->> TG_ARGV[0]);
+            RETURN OLD;
+        END IF;
+        PERFORM pg_notify('cart_changes', to_jsonb(NEW) ->> TG_ARGV[0]);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS cart_changes ON cartitem;
+    CREATE TRIGGER cart_changes AFTER INSERT OR UPDATE OR DELETE ON cartitem
+        FOR EACH ROW EXECUTE FUNCTION notify_cart_change('shoppingcart_client_client_id');
+    DROP TRIGGER IF EXISTS cart_changes ON shoppingcart;
+    CREATE TRIGGER cart_changes AFTER INSERT OR UPDATE OR DELETE ON shoppingcart
+        FOR EACH ROW EXECUTE FUNCTION notify_cart_change('client_client_id');
+"""
+
+
+def main():
+    """Installs (or updates) the notification triggers. Safe to run on a database that already has them."""
+    conn = db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(create_triggers)
+        conn.commit()
+    finally:
+        conn.close()
+    print('Triggers installed.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import time
+import select
+import logging
+import threading
+import psycopg2
+from collections import defaultdict
+
+logger = logging.getLogger('logger')
+
+
+class NotificationListener(threading.Thread):
+    """The one Postgres LISTEN connection of a process, shared by everything that needs NOTIFYs.
+
+    Subscribe before start(). Callbacks run on the listener thread, so they must only hand the
+    payload over (queue it, set an event...). Notifications sent while the connection was down
+    are lost, `on_reconnect` callbacks are called after every reconnection so subscribers can
+    resynchronize.
+    """
+
+    def __init__(self, connect, poll_interval=1.0, retry_interval=2.0):
+        super().__init__(name='pg-listener', daemon=True)
+        self.poll_interval = poll_interval
+        self.retry_interval = retry_interval
+        self.alive_at = None  # last time (monotonic) the connection was known to be up
+        self._connect = connect
+        self._callbacks = defaultdict(list)
+        self._reconnect_callbacks = []
+
+    def subscribe(self, channel, callback, on_reconnect=None):
+        self._callbacks[channel].append(callback)
+        if on_reconnect is not None:
+            self._reconnect_callbacks.append(on_reconnect)
+
+    def is_alive_within(self, seconds):
+        return self.alive_at is not None and time.monotonic() - self.alive_at <= seconds
+
+    def run(self):
+        connected_before = False
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                cur = conn.cursor()
+                for channel in self._callbacks:
+                    cur.execute(f'LISTEN "{channel}"')
+                self.alive_at = time.monotonic()
+
+                if connected_before:
+                    for callback in self._reconnect_callbacks:
+                        callback()
+                connected_before = True
+
+                while True:
+                    if select.select([conn], [], [], self.poll_interval) != ([], [], []):
+                        conn.poll()
+                        while conn.notifies:
+                            notify = conn.notifies.pop(0)
+                            for callback in self._callbacks.get(notify.channel, ()):
+                                try:
+                                    callback(notify.payload)
+                                except Exception as error:
+                                    logger.error(f'LISTEN {notify.channel} - callback error: {error}')
+                    else:
+                        cur.execute('SELECT 1')  # idle: make sure the connection is still there
+                    self.alive_at = time.monotonic()
+
+            except (Exception, psycopg2.DatabaseError) as error:
+                logger.error(f'LISTEN connection lost - error: {error}')
+                time.sleep(self.retry_interval)
+
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
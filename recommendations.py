@@ -0,0 +1,133 @@
+import time
+import threading
+import numpy as np
+import scipy.sparse as sp
+
+
+class CoPurchaseRecommender:
+    """Frequently bought together lists built from the purchaseitem order lines.
+
+    The item x item co-purchase counts are kept as a sparse matrix (LIL, so single orders can be
+    added cheaply). Only the top-K neighbours of each item are served, from two dense
+    (n_items, K) arrays: looking up an item is a dict access and a row slice, no database.
+    """
+
+    def __init__(self, top_k=10):
+        self.top_k = top_k
+        self.built_at = None
+        self._lock = threading.Lock()
+        self._index = {}  # item_id -> row of the matrices below
+        self._item_ids = np.empty(0, dtype=np.int64)
+        self._counts = sp.lil_matrix((0, 0), dtype=np.int32)
+        self._neighbours = np.full((0, top_k), -1, dtype=np.int32)  # row numbers, -1 is padding
+        self._scores = np.zeros((0, top_k), dtype=np.int32)
+
+    def build(self, order_lines):
+        """Rebuilds everything from an iterable of (order_id, item_id) rows."""
+        lines = np.array(list(order_lines), dtype=np.int64).reshape(-1, 2)
+        orders, order_rows = np.unique(lines[:, 0], return_inverse=True)
+        item_ids, item_rows = np.unique(lines[:, 1], return_inverse=True)
+
+        # orders x items incidence matrix, the co-purchase counts are its Gram matrix
+        incidence = sp.csr_matrix((np.ones(len(lines), dtype=np.int32), (order_rows, item_rows)),
+                                  shape=(len(orders), len(item_ids)))
+        incidence.data[:] = 1  # an item listed twice in one order still counts once
+        counts = (incidence.T @ incidence).tocsr()
+        if len(item_ids):
+            counts.setdiag(0)
+            counts.eliminate_zeros()
+
+        neighbours, scores = self._top_k(counts)
+
+        with self._lock:
+            self._index = {int(item_id): row for row, item_id in enumerate(item_ids)}
+            self._item_ids = item_ids
+            self._counts = counts.tolil()
+            self._neighbours = neighbours
+            self._scores = scores
+            self.built_at = time.monotonic()
+
+    def add_order(self, item_ids):
+        """Adds one new order, only the rows of the items in it are recomputed."""
+        item_ids = sorted(set(int(item_id) for item_id in item_ids))
+        if len(item_ids) < 2:
+            with self._lock:
+                for item_id in item_ids:
+                    self._row(item_id)
+            return
+
+        with self._lock:
+            rows = [self._row(item_id) for item_id in item_ids]
+            for a in rows:
+                for b in rows:
+                    if a != b:
+                        self._counts[a, b] += 1
+
+            for row in rows:
+                columns = np.array(self._counts.rows[row], dtype=np.int32)
+                data = np.array(self._counts.data[row], dtype=np.int32)
+                self._fill_row(self._neighbours, self._scores, row, columns, data)
+
+    def related(self, item_id, limit=None):
+        """Returns [(item_id, times bought together)], most frequent first."""
+        with self._lock:
+            row = self._index.get(item_id)
+            if row is None:
+                return []
+            neighbours = self._neighbours[row, :limit]
+            scores = self._scores[row, :limit]
+            keep = neighbours >= 0
+            return list(zip(self._item_ids[neighbours[keep]].tolist(), scores[keep].tolist()))
+
+    def _row(self, item_id):
+        # must be called with the lock held
+        row = self._index.get(item_id)
+        if row is not None:
+            return row
+
+        row = len(self._item_ids)
+        self._index[item_id] = row
+        self._item_ids = np.append(self._item_ids, item_id)
+        self._counts.resize((row + 1, row + 1))
+        self._neighbours = np.vstack([self._neighbours, np.full((1, self.top_k), -1, dtype=np.int32)])
+        self._scores = np.vstack([self._scores, np.zeros((1, self.top_k), dtype=np.int32)])
+        return row
+
+    def _top_k(self, counts):
+        # every row at once: one sort of all the non-zeros by (row, highest count, column), then each
+        # entry's rank inside its row is its distance from the row start in indptr
+        n_items = counts.shape[0]
+        neighbours = np.full((n_items, self.top_k), -1, dtype=np.int32)
+        scores = np.zeros((n_items, self.top_k), dtype=np.int32)
+        if counts.nnz == 0:
+            return neighbours, scores
+
+        rows = np.repeat(np.arange(n_items, dtype=np.int64), np.diff(counts.indptr))
+        rank = np.arange(counts.nnz) - counts.indptr[rows]  # sorting keeps every entry in its row's range
+        keep = rank < self.top_k
+        top = int(counts.data.max())
+        if n_items * (top + 1) * n_items < 2 ** 63:
+            # the three keys packed in one int64: sorting it alone is cheaper than a lexsort, and the
+            # count and column are read back from the sorted keys
+            key = (rows * (top + 1) + (top - counts.data)) * n_items + counts.indices
+            key.sort()
+            key = key[keep]
+            columns = key % n_items
+            data = top - key // n_items % (top + 1)
+        else:
+            order = np.lexsort((counts.indices, -counts.data, rows))[keep]
+            columns, data = counts.indices[order], counts.data[order]
+        neighbours[rows[keep], rank[keep]] = columns
+        scores[rows[keep], rank[keep]] = data
+        return neighbours, scores
+
+    def _fill_row(self, neighbours, scores, row, columns, data):
+        k = min(self.top_k, len(data))
+        neighbours[row] = -1
+        scores[row] = 0
+        if k == 0:
+            return
+
+        order = np.lexsort((columns, -data))[:k]  # highest count first, ties by row, as in _top_k
+        neighbours[row, :k] = columns[order]
+        scores[row, :k] = data[order]
@@ -0,0 +1,130 @@
+import json
+import decimal
+import datetime
+import flask
+
+try:
+    import orjson
+except ImportError:  # fall back to the standard library encoder
+    orjson = None
+
+
+class Schema:
+    """Maps cursor rows of one resource to response dicts.
+
+    `fields` is a sequence of (response key, SQL expression) pairs. The SELECT list is built
+    from the same pairs, so each row lines up with the keys without any positional indexing.
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.keys = tuple(key for key, _ in self.fields)
+        self.columns = tuple(column for _, column in self.fields)
+
+    def project(self, names):
+        """Returns the schema restricted to `names` (see parse_fields), in schema order.
+
+        Names are matched case-insensitively against the response keys; anything not in the
+        schema raises ValueError, so only whitelisted expressions ever reach the SELECT list.
+        """
+        if names is None:
+            return self
+
+        by_name = {key.lower(): (key, column) for key, column in self.fields}
+        unknown = [name for name in names if name not in by_name]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}. "
+                             f"Available fields: {', '.join(key.lower() for key in self.keys)}")
+
+        return Schema(field for field in self.fields if field[0].lower() in names)
+
+    def select_list(self):
+        return ', '.join(self.columns)
+
+    def row(self, row):
+        return dict(zip(self.keys, row))
+
+    def rows(self, rows):
+        keys = self.keys
+        return [dict(zip(keys, row)) for row in rows]
+
+
+def parse_fields(fields):
+    """Parses a `?fields=a,b` argument into a set of lower case names, None when absent."""
+    if not fields:
+        return None
+    names = {name.strip().lower() for name in fields.split(',') if name.strip()}
+    return names or None
+
+
+ITEM_SCHEMA = Schema([
+    ('Item_ID', 'item_id'),
+    ('Name', 'name'),
+    ('Category', 'category'),
+    ('Price', 'price'),
+    ('Stock', 'stock'),
+    ('Description', 'description'),
+    ('Manufacturer', 'manufacturer'),
+    ('Weight', 'weight'),
+    ('Image_URL', 'image_url'),
+    ('Total_Unit_Sales', 'total_unit_sales'),
+])
+
+CLIENT_SCHEMA = Schema([
+    ('id', 'client.client_id'),
+    ('name', 'client.name'),
+    ('email', 'client.email'),
+    ('last_purchase_date', 'MAX(purchase.order_date)'),
+    ('last_item_bought', 'MAX(item.name)'),
+])
+
+ORDER_SCHEMA = Schema([
+    ('order_id', 'purchase.order_id'),
+    ('total_price', 'purchase.total_price'),
+    ('order_date', 'purchase.order_date'),
+])
+
+ORDER_ITEM_SCHEMA = Schema([
+    ('item_id', 'purchaseitem.item_item_id'),
+    ('quantity', 'purchaseitem.quantity'),
+])
+
+CART_LINE_SCHEMA = Schema([
+    ('item_id', 'cartitem.item_item_id'),
+    ('name', 'item.name'),
+    ('price', 'item.price'),
+    ('quantity', 'cartitem.quantity'),
+    ('line_total', 'ROUND((item.price * cartitem.quantity)::numeric, 2)'),
+])
+
+
+def default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+else:
+    def dumps(obj):
+        return json.dumps(obj, default=default, separators=(',', ':')).encode()
+
+
+def json_response(response, headers=None):
+    return flask.Response(dumps(response), status=response['status'], headers=headers,
+                          mimetype='application/json')
+
+
+def project_fields(schema, fields):
+    """`schema` narrowed to the parsed `fields`, or the 400 response naming an unknown field.
+
+    Returns (schema, None) or (None, response).
+    """
+    try:
+        return schema.project(fields), None
+    except ValueError as error:
+        return None, json_response({'status': 400, 'message': str(error)})
@@ -0,0 +1,173 @@
+import re
+import json
+import queue
+import random
+import hashlib
+import logging
+import datetime
+import functools
+import threading
+import psycopg2
+from logging.handlers import RotatingFileHandler
+from db import db_connection, setting
+
+SLOW_QUERY_MS = setting('SLOW_QUERY_MS', 200, float)
+SLOW_QUERY_EXPLAIN_SAMPLE = setting('SLOW_QUERY_EXPLAIN_SAMPLE', 0.1, float)
+SLOW_QUERY_LOG = setting('SLOW_QUERY_LOG', 'slow_queries.log')
+SLOW_QUERY_MAX_FINGERPRINTS = setting('SLOW_QUERY_MAX_FINGERPRINTS', 1000, int)
+SLOW_QUERY_EXPLAIN_QUEUE = setting('SLOW_QUERY_EXPLAIN_QUEUE', 100, int)
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = setting('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 30000, int)
+SLOW_QUERY_EXPLAIN_LOCK_TIMEOUT_MS = setting('SLOW_QUERY_EXPLAIN_LOCK_TIMEOUT_MS', 100, int)
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|%s")
+_spaces = re.compile(r'\s+')
+_locking = re.compile(r'\bFOR\s+(?:UPDATE|SHARE|NO\s+KEY\s+UPDATE|KEY\s+SHARE)\b', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    """Same query shape -> same text: literals and placeholders become ?, whitespace is collapsed."""
+    return _spaces.sub(' ', _literals.sub('?', sql)).strip()
+
+
+def param_shape(vars):
+    if vars is None:
+        return []
+    values = vars.values() if isinstance(vars, dict) else vars
+    shape = []
+    for value in values:
+        if isinstance(value, (list, tuple)):
+            shape.append(f'{type(value).__name__}[{len(value)}]')
+        else:
+            shape.append(type(value).__name__)
+    return shape
+
+
+def fingerprint(normalized):
+    return hashlib.md5(normalized.encode()).hexdigest()[:12]
+
+
+def slow_query_logger():
+    logger = logging.getLogger('slow_queries')
+    if not logger.handlers:
+        handler = RotatingFileHandler(SLOW_QUERY_LOG, maxBytes=10 * 1024 * 1024, backupCount=5)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+class SlowQueryLog:
+    """Per-fingerprint timings of every statement, plus a log of the ones over `threshold_ms` and
+    of the ones that failed (`error`, e.g. a statement timeout: the slowest of all).
+
+    The plan of a sample of the slow SELECTs is captured off the request path: a background thread
+    runs EXPLAIN (ANALYZE, BUFFERS) on its own connection and writes the entry with it. A statement
+    that failed only gets a plain EXPLAIN, ANALYZE would run into the same timeout. So does a
+    SELECT ... FOR UPDATE/SHARE: re-running it would take the row locks the requests wait on, and
+    the explain connection's short lock_timeout is there in case one slips through. Other statements
+    are never re-run, EXPLAIN ANALYZE really executes them.
+    """
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, explain_sample=SLOW_QUERY_EXPLAIN_SAMPLE,
+                 max_fingerprints=SLOW_QUERY_MAX_FINGERPRINTS, explain_queue=SLOW_QUERY_EXPLAIN_QUEUE,
+                 explain_timeout_ms=SLOW_QUERY_EXPLAIN_TIMEOUT_MS,
+                 explain_lock_timeout_ms=SLOW_QUERY_EXPLAIN_LOCK_TIMEOUT_MS):
+        self.threshold_ms = threshold_ms
+        self.explain_sample = explain_sample
+        self.max_fingerprints = max_fingerprints
+        self.explain_timeout_ms = explain_timeout_ms
+        self.explain_lock_timeout_ms = explain_lock_timeout_ms
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._explain_queue = queue.Queue(maxsize=explain_queue)
+        self._explainer = None
+
+    def record(self, cursor, query, vars, elapsed_ms, error=None):
+        sql = query if isinstance(query, str) else str(query)
+        normalized = normalize(sql)
+        key = fingerprint(normalized)
+
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    # make room by forgetting the fingerprint that cost the least overall
+                    del self._stats[min(self._stats, key=lambda k: self._stats[k]['total_ms'])]
+                stats = self._stats[key] = {'fingerprint': key, 'sql': normalized, 'calls': 0,
+                                            'total_ms': 0.0, 'max_ms': 0.0, 'slow_calls': 0, 'errors': 0}
+            stats['calls'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            stats['params'] = param_shape(vars)
+            if elapsed_ms >= self.threshold_ms:
+                stats['slow_calls'] += 1
+            if error is not None:
+                stats['errors'] += 1
+
+        if elapsed_ms < self.threshold_ms and error is None:
+            return
+
+        entry = {'time': datetime.datetime.now().isoformat(),
+                 'fingerprint': key,
+                 'elapsed_ms': round(elapsed_ms, 3),
+                 'sql': normalized,
+                 'params': param_shape(vars)}
+        if error is not None:
+            entry['error'] = error
+
+        if (elapsed_ms >= self.threshold_ms and normalized.lstrip('( ').upper().startswith('SELECT') and
+                random.random() < self.explain_sample):
+            # mogrify only formats the statement, it doesn't go to the server
+            statement = cursor.mogrify(query, vars)
+            analyze = error is None and not _locking.search(normalized)
+            try:
+                self._explain_queue.put_nowait((entry, statement, analyze))
+                self._start_explainer()
+                return  # written by the explainer, with the plan
+            except queue.Full:
+                entry['plan'] = 'EXPLAIN skipped: too many plans waiting'
+
+        slow_query_logger().info(json.dumps(entry))
+
+    def _start_explainer(self):
+        # started on the first slow query, so it runs in the worker process, not before the fork
+        with self._lock:
+            if self._explainer is None:
+                self._explainer = threading.Thread(target=self._explain_loop, name='slow-query-explain', daemon=True)
+                self._explainer.start()
+
+    def _explain_loop(self):
+        conn = None
+        while True:
+            entry, statement, analyze = self._explain_queue.get()
+            try:
+                if conn is None or conn.closed:
+                    conn = db_connection(options=f'-c statement_timeout={self.explain_timeout_ms} '
+                                                 f'-c lock_timeout={self.explain_lock_timeout_ms}')
+                entry['plan'] = self.explain(conn, statement, analyze)
+            except psycopg2.Error as error:
+                entry['plan'] = f'EXPLAIN failed: {error}'
+                if conn is not None and conn.closed:
+                    conn = None
+            slow_query_logger().info(json.dumps(entry))
+
+    def explain(self, conn, statement, analyze=True):
+        # a plain connection, so the EXPLAIN itself is not timed and recorded again
+        cur = conn.cursor()
+        try:
+            options = 'ANALYZE, BUFFERS' if analyze else 'VERBOSE'
+            cur.execute(f'EXPLAIN ({options}) '.encode() + statement)
+            return '\n'.join(row[0] for row in cur.fetchall())
+        finally:
+            cur.close()
+            conn.rollback()  # whatever ANALYZE ran is undone
+
+    def top(self, limit=10, sort='total_ms'):
+        with self._lock:
+            stats = [dict(stats, mean_ms=stats['total_ms'] / stats['calls']) for stats in self._stats.values()]
+        return sorted(stats, key=lambda stats: stats[sort], reverse=True)[:limit]
+
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,56 @@
+import sys
+import argparse
+import subprocess
+
+# run in a fresh interpreter every time, so nothing is already imported or cached
+IMPORT_ONLY = """
+import time
+start = time.perf_counter()
+import api
+print(time.perf_counter() - start)
+"""
+
+BOOT = """
+import time
+start = time.perf_counter()
+import api
+imported = time.perf_counter()
+api.init_worker()
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def run(code):
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return [float(value) for value in output.split()]
+
+
+def heaviest_imports(count):
+    # -X importtime writes "import time: self [us] | cumulative | imported package" lines to stderr
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import api'],
+                            check=True, capture_output=True, text=True).stderr
+    imports = []
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, name = line.split('|')
+        imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure how long the API takes to import and to boot a worker.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--boot', action='store_true',
+                        help='also run init_worker() (needs the database; starts the listener and the catalog load)')
+    parser.add_argument('--top', type=int, default=10, help='show the N slowest imports')
+    args = parser.parse_args()
+
+    imports = [run(IMPORT_ONLY)[0] for _ in range(args.repeat)]
+    print(f'import api: best {min(imports) * 1000:8.1f} ms   worst {max(imports) * 1000:8.1f} ms')
+
+    if args.boot:
+        boots = [run(BOOT)[1] for _ in range(args.repeat)]
+        print(f'init_worker: best {min(boots) * 1000:8.1f} ms   worst {max(boots) * 1000:8.1f} ms')
+
+    print('\nslowest imports (cumulative):')
+    for cumulative, name in heaviest_imports(args.top):
+        print(f'{cumulative / 1000:8.1f} ms  {name}')
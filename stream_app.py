@@ -0,0 +1,98 @@
+import os
+import math
+import flask
+import logging
+from db import db_connection, setting
+from serializers import json_response
+from notifications import NotificationListener
+from item_stream import ChangeBroadcaster, event_stream
+import metrics
+
+# Server-Sent Events of item changes, served apart from the API: every open stream is a long-lived
+# connection, so this app runs on gevent workers (gunicorn.stream.conf.py) where a subscriber costs
+# a greenlet instead of an OS thread. The reverse proxy sends /proj/api/items/stream here.
+
+StatusCodes = {
+    'success': 200,
+    'api_error': 400,
+    'unavailable': 503,
+}
+
+MAX_STREAM_IDS = setting('MAX_ITEMS_BATCH', 100, int)
+STREAM_HEARTBEAT = setting('STREAM_HEARTBEAT', 15, float)
+STREAM_COALESCE = setting('STREAM_COALESCE', 0.1, float)
+STREAM_MAX_DURATION = setting('STREAM_MAX_DURATION', 3600, float)
+
+# one LISTEN connection per process, started in init_worker
+listener = NotificationListener(db_connection)
+# price/stock changes pushed to the open streams, see item_stream.py
+item_changes = ChangeBroadcaster(listener,
+                                 max_subscribers=setting('STREAM_MAX_SUBSCRIBERS', 5000, int),
+                                 max_pending=setting('STREAM_MAX_PENDING', 1000, int))
+
+app = flask.Flask(__name__)
+logger = logging.getLogger('logger')
+
+
+# 20. Stream Item Changes: http://localhost:8081/proj/api/items/stream (GET)
+# Server-Sent Events, um evento "item" por alteração de preço ou stock: {"op": "UPDATE", "item_id": 1246, "price": 45.99, "stock": 80}
+# só alguns itens: http://localhost:8081/proj/api/items/stream?ids=1246,1537
+@app.route('/proj/api/items/stream', methods=['GET'], strict_slashes=True)
+def stream_item_changes():
+    item_ids = None
+    ids = flask.request.args.get('ids')
+    if ids is not None:
+        try:
+            item_ids = frozenset(int(item_id) for item_id in ids.split(',') if item_id.strip())
+        except ValueError:
+            response = {'status': StatusCodes['api_error'],
+                        'message': 'Item IDs must be integers.'}
+            return json_response(response)
+
+        if not item_ids or len(item_ids) > MAX_STREAM_IDS:
+            response = {'status': StatusCodes['api_error'],
+                        'message': f'Between 1 and {MAX_STREAM_IDS} item IDs must be requested.'}
+            return json_response(response)
+
+    subscription = item_changes.subscribe(item_ids)
+    if subscription is None:
+        metrics.incr('stream.rejected')
+        response = {'status': StatusCodes['unavailable'],
+                    'message': 'Too many open streams, try again shortly.'}
+        return json_response(response, headers={'Retry-After': str(math.ceil(STREAM_HEARTBEAT))})
+
+    events = event_stream(item_changes, subscription, heartbeat=STREAM_HEARTBEAT,
+                          coalesce=STREAM_COALESCE, max_duration=STREAM_MAX_DURATION)
+    response = flask.Response(events, mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # the generator's finally doesn't run when the response is closed before the first event
+    response.call_on_close(lambda: item_changes.unsubscribe(subscription))
+    return response
+
+
+# 21. Get Stream Metrics: http://localhost:8081/proj/api/items/stream/metrics (GET)
+@app.route('/proj/api/items/stream/metrics', methods=['GET'], strict_slashes=True)
+def get_stream_metrics():
+    response = {'status': StatusCodes['success'],
+                'message': 'Metrics retrieved successfully.',
+                'data': {'counters': metrics.snapshot(),
+                         'open_streams': item_changes.count(),
+                         'listener_alive': listener.is_alive_within(STREAM_HEARTBEAT)}}
+    return json_response(response)
+
+
+def init_worker():
+    """Per-process initialization, called by gunicorn in every worker after the fork."""
+    logging.basicConfig(format='%(asctime)s [%(levelname)s]:  %(message)s', datefmt='%H:%M:%S')
+    logger.setLevel(logging.INFO)
+    listener.start()
+    logger.info(f'Stream worker {os.getpid()} ready')
+
+
+if __name__ == '__main__':
+    # development server, one thread per stream; in production use: gunicorn -c gunicorn.stream.conf.py stream_app:app
+    host = setting('STREAM_HOST', '127.0.0.1')
+    port = setting('STREAM_PORT', 8081, int)
+
+    init_worker()
+    app.run(host=host, threaded=True, port=port)
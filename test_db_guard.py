@@ -0,0 +1,48 @@
+import time
+import pytest
+import psycopg2
+from db import db_connection
+from db_guard import CircuitBreaker, CircuitOpenError, breaker
+
+
+def tripped_breaker(reset_timeout):
+    circuit = CircuitBreaker(window=2, min_calls=1, failure_rate=0.5, reset_timeout=reset_timeout)
+    circuit.record_failure()
+    assert circuit.state == 'open'
+    return circuit
+
+
+def test_leaked_probe_is_reclaimed():
+    circuit = tripped_breaker(reset_timeout=0.05)
+    time.sleep(0.06)
+
+    assert circuit.before_call() is True  # the probe, its connection is never used nor closed
+    with pytest.raises(CircuitOpenError):
+        circuit.before_call()
+
+    time.sleep(0.06)
+    assert circuit.before_call() is True  # handed out again once reset_timeout has passed
+    circuit.record_success()
+    assert circuit.state == 'closed'
+    assert circuit.before_call() is False
+
+
+def test_malformed_create_item_does_not_wedge_the_breaker(monkeypatch):
+    try:
+        db_connection().close()
+    except psycopg2.OperationalError:
+        pytest.skip('needs the database')
+    import api
+
+    monkeypatch.setattr(breaker, 'reset_timeout', 0.05)
+    with breaker._lock:
+        breaker._trip()
+    time.sleep(0.06)
+
+    client = api.app.test_client()
+    for payload in ({'name': 'Incomplete'}, ['not', 'an', 'object']):
+        assert client.post('/proj/api/items', json=payload).status_code == 400
+
+    time.sleep(0.06)
+    assert client.get('/proj/api/clients').status_code == 200
+    assert breaker.state == 'closed'